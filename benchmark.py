@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+
+# Benchmarks liquidity.py against a local Binance stand-in with injected latency.
+# Usage: python3 benchmark.py --symbols 200 --latency 50 --output benchmark.json
+import argparse
+import atexit
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+class BinanceStandIn(BaseHTTPRequestHandler):
+    latency = 0
+    interval_index = None
+    interval_time = None
+    symbols = []
+    order_id = 0
+    used_weight = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, weight=1):
+        with BinanceStandIn.lock:
+            BinanceStandIn.used_weight += weight
+            used_weight = BinanceStandIn.used_weight
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-MBX-USED-WEIGHT-1M', str(used_weight % 1200))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def next_order_id(self):
+        with BinanceStandIn.lock:
+            BinanceStandIn.order_id += 1
+            return BinanceStandIn.order_id
+
+    def klines(self, symbol, interval, limit, start_time, end_time):
+        # Like Binance, startTime serves the first candles from it, otherwise the last ones before endTime
+        now = int(time.time() * 1000)
+        last_index = BinanceStandIn.interval_index(min(int(end_time), now) if end_time is not None else now, interval)
+        if (start_time is not None):
+            first_index = BinanceStandIn.interval_index(int(start_time) - 1, interval) + 1
+            last_index = min(last_index, first_index + limit - 1)
+        else:
+            first_index = last_index - limit + 1
+        candles = []
+        for index in range(first_index, last_index + 1):
+            open_time = BinanceStandIn.interval_time(index, interval)
+            rng = random.Random('{}{}'.format(symbol, open_time))
+            open = 100 * (1 + rng.uniform(-0.1, 0.1))
+            close = open * (1 + rng.uniform(-0.05, 0.05))
+            if (symbol.startswith('RED')):
+                close = open * 0.99
+            high = max(open, close) * (1 + rng.uniform(0, 0.03))
+            low = min(open, close) * (1 - rng.uniform(0, 0.03))
+            candles.append([open_time, str(open), str(high), str(low), str(close), '1000', BinanceStandIn.interval_time(index + 1, interval) - 1, '100000', 500, '500', '50000', '0'])
+        return candles
+
+    def handle_request(self, method):
+        time.sleep(BinanceStandIn.latency)
+        url = urlparse(self.path)
+        query = { key: value[0] for key, value in parse_qs(url.query).items() }
+        if (url.path == '/fapi/v1/exchangeInfo'):
+            self.send_json({ 'symbols': [{ 'symbol': symbol, 'status': 'TRADING', 'contractType': 'PERPETUAL', 'quantityPrecision': 3, 'pricePrecision': 4 } for symbol in BinanceStandIn.symbols] }, 1)
+        elif (url.path == '/api/v3/exchangeInfo'):
+            self.send_json({ 'symbols': [{ 'symbol': symbol, 'status': 'TRADING', 'baseAssetPrecision': 8 } for symbol in BinanceStandIn.symbols] }, 10)
+        elif (url.path in ('/fapi/v1/continuousKlines', '/api/v3/klines')):
+            symbol = query.get('pair') or query.get('symbol')
+            self.send_json(self.klines(symbol, query['interval'], int(query.get('limit', 500)), query.get('startTime'), query.get('endTime')), 1)
+        elif (url.path == '/fapi/v1/listenKey'):
+            self.send_json({ 'listenKey': 'benchmark' }, 1)
+        elif (url.path == '/fapi/v1/openOrders'):
+            self.send_json([], 1)
+        elif (url.path == '/fapi/v2/positionRisk'):
+            self.send_json([{ 'symbol': query.get('symbol'), 'positionAmt': '0' }], 5)
+        elif (url.path == '/fapi/v1/order'):
+            self.send_json({ 'orderId': self.next_order_id(), 'status': 'FILLED', 'avgPrice': '100.0' }, 1)
+        elif (url.path == '/fapi/v1/batchOrders' and method == 'POST'):
+            self.send_json([{ 'orderId': self.next_order_id(), 'status': 'NEW' } for order in json.loads(query['batchOrders'])], 5)
+        elif (url.path == '/fapi/v1/batchOrders'):
+            self.send_json([{ 'orderId': int(order_id), 'status': 'CANCELED' } for order_id in json.loads(query['orderIdList'])], 1)
+        else:
+            self.send_json({}, 1)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+def serve_stand_in(symbols, latency):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from liquidity import get_interval_index, get_interval_time
+    BinanceStandIn.interval_index = staticmethod(get_interval_index)
+    BinanceStandIn.interval_time = staticmethod(get_interval_time)
+    BinanceStandIn.symbols = symbols
+    BinanceStandIn.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), BinanceStandIn)
+    server.daemon_threads = True
+    print(server.server_address[1], flush=True)
+    server.serve_forever()
+
+def start_stand_in(symbols, latency):
+    # Its own process, so the stand-in does not compete with the measured code for the GIL
+    config = json.dumps({ 'symbols': symbols, 'latency': latency })
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', config], stdout=subprocess.PIPE, text=True)
+    port = int(process.stdout.readline())
+    return process, 'http://127.0.0.1:{}'.format(port)
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'mean_ms': statistics.mean(samples) * 1000,
+        'p50_ms': samples[len(samples) // 2] * 1000,
+        'p99_ms': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+    }
+
+def benchmark_scan(liquidity, symbols, concurrency):
+    results = {}
+    for workers in sorted({ 1, concurrency }):
+        # Every run starts from an empty candle store
+        liquidity.KLINE_STORE.connection = None
+        liquidity.KLINE_STORE_PATH = os.path.join(tempfile.mkdtemp(), 'klines.db')
+        with contextlib.redirect_stdout(io.StringIO()):
+            scan_time = liquidity.check_best_trade('1d', workers)
+        results['concurrency_{}'.format(workers)] = { 'symbols': len(symbols), 'seconds': scan_time }
+    return results
+
+def benchmark_poll_loop(liquidity, iterations):
+    session = liquidity.TradeSession('REDUSDT', 10, '1d', 2)
+    samples = { 'uncached': [], 'cached': [] }
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(iterations):
+            # A poll that downloads the candles, then one served by the last candles cache
+            with liquidity.KLINE_CACHE_LOCK:
+                liquidity.KLINE_CACHE.clear()
+            for kind in ('uncached', 'cached'):
+                start = time.perf_counter()
+                liquidity.trade_the_open(session)
+                samples[kind].append(time.perf_counter() - start)
+    return { kind: summarize(kind_samples) for kind, kind_samples in samples.items() }
+
+def benchmark_orders(liquidity, symbol, orders):
+    session = liquidity.TradeSession(symbol, 10, '1d', 2)
+    with contextlib.redirect_stdout(io.StringIO()):
+        liquidity.prepare_session(session)
+        for i in range(orders):
+            liquidity.open_position_binance_futures(session, 110, 95, 100)
+    return {
+        'signal_to_fill': summarize([latency['market_filled'] - latency['signal'] for latency in session.latency]),
+        'signal_to_brackets': summarize([latency['brackets_placed'] - latency['signal'] for latency in session.latency]),
+    }
+
+def benchmark_cold_start(runs, budget):
+    # Fresh interpreters only importing liquidity.py and parsing arguments, against a bare numpy and requests import run alternately
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'liquidity.py')
+    samples = []
+    baseline_samples = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import numpy, requests'], stdout=subprocess.DEVNULL, check=True)
+        baseline_samples.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        subprocess.run([sys.executable, script, '--help'], stdout=subprocess.DEVNULL, check=True)
+        samples.append(time.perf_counter() - start)
+    result = summarize(samples)
+    baseline = summarize(baseline_samples)
+    overhead = result['p50_ms'] - baseline['p50_ms']
+    result.update(baseline=baseline, overhead_ms=overhead, budget_ms=budget, within_budget=overhead <= budget)
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark liquidity.py against a local Binance stand-in.')
+    parser.add_argument('--symbols', type=int, help='Number of perpetual symbols served.', default=200)
+    parser.add_argument('--latency', type=float, help='Latency injected on every request in milliseconds.', default=50)
+    parser.add_argument('--concurrency', type=int, help='Concurrent requests used by the scan.', default=10)
+    parser.add_argument('--iterations', type=int, help='Poll loop iterations measured.', default=50)
+    parser.add_argument('--orders', type=int, help='Orders placed.', default=20)
+    parser.add_argument('--cold-start-runs', type=int, help='Cold starts measured.', default=10)
+    parser.add_argument('--cold-start-budget', type=float, help='Maximum median cold start in milliseconds over a bare numpy and requests import, the benchmark fails over it.', default=150)
+    parser.add_argument('--cold-start-only', action='store_true', help='Only measure the cold start, without the stand-in.')
+    parser.add_argument('--output', type=str, help='JSON file where results are written.', default='benchmark.json')
+    parser.add_argument('--serve', type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if (args.serve):
+        serve_stand_in(**json.loads(args.serve))
+        sys.exit()
+
+    if (args.cold_start_only):
+        cold_start = benchmark_cold_start(args.cold_start_runs, args.cold_start_budget)
+        print(json.dumps(cold_start, indent=2))
+        if (not cold_start['within_budget']):
+            print('Cold start is {:.0f} ms over a bare import, the budget is {:.0f} ms.'.format(cold_start['overhead_ms'], args.cold_start_budget))
+            sys.exit(1)
+        sys.exit()
+
+    symbols = ['SYM{}USDT'.format(i) for i in range(args.symbols)] + ['REDUSDT']
+    stand_in, base_url = start_stand_in(symbols, args.latency / 1000)
+    atexit.register(stand_in.terminate)
+    workdir = tempfile.mkdtemp()
+
+    # liquidity.py reads endpoints and paths when imported
+    os.environ['BINANCE_FUTURES_BASE_URL'] = base_url
+    os.environ['BINANCE_SPOT_BASE_URL'] = base_url
+    os.environ['KLINE_STORE_PATH'] = os.path.join(workdir, 'klines.db')
+    os.environ['EXCHANGE_INFO_CACHE_PATH'] = os.path.join(workdir, 'exchange_info.json')
+    os.environ['SESSION_JOURNAL_PATH'] = os.path.join(workdir, 'sessions.db')
+    os.environ.setdefault('API_KEY', 'benchmark')
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import liquidity
+
+    results = {
+        'time': time.time(),
+        'parameters': vars(args),
+        'scan': benchmark_scan(liquidity, symbols, args.concurrency),
+        'poll_loop': benchmark_poll_loop(liquidity, args.iterations),
+        'orders': benchmark_orders(liquidity, symbols[0], args.orders),
+        'kline_cache': liquidity.get_kline_cache_stats(),
+        'cold_start': benchmark_cold_start(args.cold_start_runs, args.cold_start_budget),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    if (not results['cold_start']['within_budget']):
+        print('Cold start is {:.0f} ms over a bare import, the budget is {:.0f} ms.'.format(results['cold_start']['overhead_ms'], args.cold_start_budget))
+        sys.exit(1)
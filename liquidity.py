@@ -6,18 +6,35 @@ import sys
 import requests
 import time
 import argparse
+import atexit
+import bisect
 import os
-
-from datetime import datetime
-from binance_f import RequestClient
-from binance_f.constant.test import *
-from binance_f.base.printobject import *
-from binance_f.model.constant import *
-from decimal import Decimal
+import csv
+import glob
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
+import sqlite3
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
 from dotenv import load_dotenv
+import numpy as np
 from enum import Enum
 from simple_chalk import yellow, red, green, white
 
+# Modules needed by a single mode (streams, screener, sweep, tick replay) are imported where they are used
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 load_dotenv()
 
 API_KEY = os.environ.get('API_KEY')
@@ -33,38 +50,165 @@ MAX_STOP_LOSS_RISK = 3
 
 INITIAL_DELAY = False
 
+# Backtest defaults
+BACKTEST_RESOLUTION = '5m'
+BACKTEST_FEE = 0.0004
+BACKTEST_DAYS = 365
+SWEEP_TOP_RESULTS = 20
+TICK_CHUNK_SIZE = 1000000
+WICK_LOOKBACK = 30
+WICK_TOP_RESULTS = 10
+FIB_RETRACEMENT_LEVELS = (0.236, 0.382, 0.5, 0.618)
+
+# Kline stream reconnection
+STREAM_RECONNECT_DELAY = 1
+STREAM_MAX_RECONNECT_DELAY = 60
+STREAM_PING_INTERVAL = 60
+USER_DATA_KEEPALIVE_INTERVAL = 30 * 60
+SCREENER_STREAMS_PER_CONNECTION = 200
+SCREENER_UPDATE_INTERVAL = 1
+
+# HTTP session shared by every REST call, and request weight tracking per host
+HTTP_SESSION = None
+HTTP_TIMEOUT = 10
+SCAN_CONCURRENCY = 10
+# Token bucket per host refilled every minute, orders may use more of it than market data
+REQUEST_WEIGHT_LOCK = threading.Condition()
+REQUEST_WEIGHT_USED = {}
+REQUEST_WEIGHT_MINUTE = {}
+REQUEST_WEIGHT_WAITERS = {}
+REQUEST_WEIGHT_TICKETS = itertools.count()
+REQUEST_WEIGHT_BACKOFF_UNTIL = {}
+REQUEST_WEIGHT_BACKOFF_RATIO = 0.8
+REQUEST_WEIGHT_ORDER_RATIO = 0.95
+REQUEST_PRIORITY_ORDER = 0
+REQUEST_PRIORITY_MARKET_DATA = 1
+REQUESTS_IN_FLIGHT = {}
+REQUESTS_IN_FLIGHT_LOCK = threading.Lock()
+BINANCE_RECV_WINDOW = 5000
+HTTP_KEEP_ALIVE_INTERVAL = 30
+
+# Metrics, every hook is skipped unless enabled with --metrics-file
+METRICS_ENABLED = False
+METRICS_FILE = None
+METRICS_FORMAT = 'json'
+METRICS_INTERVAL = 10
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_LOCK = threading.Lock()
+METRICS_HISTOGRAMS = {}
+METRICS_COUNTERS = {}
+METRICS_GAUGES = {}
+
+# Orders are sent from their own pool so cancellations and brackets go out in parallel
+ORDER_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+# Paper trading, futures orders are filled locally against candles when set with --paper
+PAPER_EXCHANGE = None
+PAPER_SLIPPAGE = 0.0005
+
+# Portfolio limits in USDT, set with --max-exposure, --max-symbol-margin and --max-correlated-exposure
+RISK_ENGINE = None
+RISK_CORRELATION_THRESHOLD = 0.8
+RISK_CORRELATION_LOOKBACK = 30
+RISK_MIN_SCALE = 0.1
+
+# Exchange info cache indexed by symbol, refreshed in the background once expired
+EXCHANGE_INFO_CACHE_PATH = os.environ.get('EXCHANGE_INFO_CACHE_PATH', 'exchange_info.json')
+EXCHANGE_INFO_TTL = 60 * 60
+EXCHANGE_INFO = {}
+EXCHANGE_INFO_LOCK = threading.Lock()
+EXCHANGE_INFO_REFRESHING = set()
+
+# Local candle store, one connection per thread
+KLINE_STORE_PATH = os.environ.get('KLINE_STORE_PATH', 'klines.db')
+KLINE_STORE = threading.local()
+BINANCE_KLINES_MAX_LIMIT = 1000
+# Candles are parsed once into this structured array layout, same columns as the store
+CANDLE_DTYPE = np.dtype([
+    ('open_time', np.int64),
+    ('open', np.float64),
+    ('high', np.float64),
+    ('low', np.float64),
+    ('close', np.float64),
+    ('volume', np.float64),
+    ('close_time', np.int64),
+    ('trades', np.int64),
+])
+# Open time, OHLC, volume, close time and number of trades in Binance kline responses
+BINANCE_KLINE_COLUMNS = [0, 1, 2, 3, 4, 5, 6, 8]
+
+# Last candles shared by concurrent consumers, kept a fraction of the interval
+# (1 second at most) and never past the current candle close
+KLINE_CACHE = OrderedDict()
+KLINE_CACHE_LOCK = threading.Lock()
+KLINE_CACHE_IN_FLIGHT = {}
+KLINE_CACHE_SIZE = 1024
+KLINE_CACHE_TTL_RATIO = 0.001
+KLINE_CACHE_MAX_TTL = 1
+KLINE_CACHE_STATS = { 'hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0 }
+
+# Append-only journal of trade session state, one connection per thread
+SESSION_JOURNAL_PATH = os.environ.get('SESSION_JOURNAL_PATH', 'sessions.db')
+SESSION_JOURNAL = threading.local()
+BRACKET_ORDER_TYPES = ('STOP_MARKET', 'TAKE_PROFIT_MARKET')
+BINANCE_BATCH_ORDERS_MAX = 10
+INTERVAL_MILLISECONDS = {
+    '1m': 60 * 1000,
+    '5m': 5 * 60 * 1000,
+    '15m': 15 * 60 * 1000,
+    '30m': 30 * 60 * 1000,
+    '1h': 60 * 60 * 1000,
+    '4h': 4 * 60 * 60 * 1000,
+    '12h': 12 * 60 * 60 * 1000,
+    '1d': 24 * 60 * 60 * 1000,
+    '3d': 3 * 24 * 60 * 60 * 1000,
+    '1w': 7 * 24 * 60 * 60 * 1000,
+    '2w': 14 * 24 * 60 * 60 * 1000,
+    '1M': 31 * 24 * 60 * 60 * 1000,
+}
+
+# Intervals built from smaller candles: 2w is not served by Binance, and with
+# --base-interval every other interval is built from the base interval candles
+BASE_INTERVAL = None
+SYNTHESIZED_INTERVALS = { '2w': '1w' }
+NATIVE_ONLY_INTERVALS = ('1M',)
+# Weekly candles open on Monday, 2 week candles on Monday April 12 2021
+INTERVAL_ANCHORS = { '1w': 345600000, '2w': 1618185600000 }
+
 # Futures environment variables
-BINANCE_FUTURES_BASE_URL = "https://fapi.binance.com"
+BINANCE_FUTURES_BASE_URL = os.environ.get('BINANCE_FUTURES_BASE_URL', "https://fapi.binance.com")
+BINANCE_FUTURES_WEIGHT_LIMIT = 2400
+BINANCE_FUTURES_STREAM_URL = os.environ.get('BINANCE_FUTURES_STREAM_URL', "wss://fstream.binance.com")
 BINANCE_FUTURES_KLINES_ENDPOINT = "/fapi/v1/continuousKlines"
 BINANCE_FUTURES_EXCHANGE_INFO_ENDPOINT = "/fapi/v1/exchangeInfo"
+BINANCE_FUTURES_PING_ENDPOINT = "/fapi/v1/ping"
+BINANCE_FUTURES_ORDER_ENDPOINT = "/fapi/v1/order"
+BINANCE_FUTURES_BATCH_ORDERS_ENDPOINT = "/fapi/v1/batchOrders"
+BINANCE_FUTURES_LEVERAGE_ENDPOINT = "/fapi/v1/leverage"
+BINANCE_FUTURES_MARGIN_TYPE_ENDPOINT = "/fapi/v1/marginType"
+BINANCE_FUTURES_OPEN_ORDERS_ENDPOINT = "/fapi/v1/openOrders"
+BINANCE_FUTURES_POSITION_RISK_ENDPOINT = "/fapi/v2/positionRisk"
+BINANCE_FUTURES_LISTEN_KEY_ENDPOINT = "/fapi/v1/listenKey"
 
 # Spot environment variables
-BINANCE_SPOT_BASE_URL = "https://api.binance.com"
+BINANCE_SPOT_BASE_URL = os.environ.get('BINANCE_SPOT_BASE_URL', "https://api.binance.com")
+BINANCE_SPOT_WEIGHT_LIMIT = 6000
+BINANCE_SPOT_STREAM_URL = os.environ.get('BINANCE_SPOT_STREAM_URL', "wss://stream.binance.com:9443")
 BINANCE_SPOT_CREATE_ORDER_ENDPOINT = "/api/v3/order/test"
 BINANCE_SPOT_KLINES_ENDPOINT = "/api/v3/klines"
 BINANCE_SPOT_EXCHANGE_INFO_ENDPOINT = "/api/v3/exchangeInfo"
 
-TIMES_GREEN = 0
-TIMES_RED = 0
-
-LAST_CANDLE_RED = True
-LAST_CANDLE_GREEN = True
-
-LAST_LOW_PRICE = 999999
-LAST_HIGH_PRICE = 0
-
-STOP_LOSS_REACHED = False
-STOP_LOSS = 0
-
-TARGET_REACHED = False
-TARGET = 99999
-
-STOP_LOSS_ORDER_ID = None
-TAKE_PROFIT_ORDER_ID = None
+# Request weights different from 1, futures klines weight depends on the limit
+REQUEST_WEIGHTS = {
+    BINANCE_FUTURES_BATCH_ORDERS_ENDPOINT: 5,
+    BINANCE_FUTURES_POSITION_RISK_ENDPOINT: 5,
+    BINANCE_SPOT_KLINES_ENDPOINT: 2,
+    BINANCE_SPOT_EXCHANGE_INFO_ENDPOINT: 20,
+}
 
 class Intervals(Enum):
-    #FIVETEEN_MINUTES = "15m"
-    #THIRTY_MINUTES = "30m"
+    FIVETEEN_MINUTES = "15m"
+    THIRTY_MINUTES = "30m"
     HOUR = "1h"
     FOUR_HOURS = "4h"
     TWELVE_HOURS = "12h"
@@ -126,57 +270,891 @@ class MarketSide(Enum):
         except KeyError:
             raise ValueError()
 
-def check_best_trade(interval=Intervals.DAY):
-    request_client = RequestClient(api_key=API_KEY, secret_key=SECRET_KEY)
-
-    # Request info of all symbols to retrieve precision
-    response = requests.get(BINANCE_FUTURES_BASE_URL + BINANCE_FUTURES_EXCHANGE_INFO_ENDPOINT)
-
-    exchange_info = response.json()
-
-    price_precision = 0
-    best_bullish_wicks = []
-    best_bearish_wicks = []
-    print('Number of pairs to check approx: ', len(exchange_info['symbols']))
-    for item in exchange_info['symbols']:
-        if (not item['contractType'] == 'PERPETUAL'):
-            continue
-        print('\t * Checking: {}'.format(item['symbol']))
-        candles = get_last_binance_candles(item['symbol'], interval, Markets.FUTURES)
-        if (not len(candles) > 1):
-            continue
-        current_candle = candles[1]
-        cc_open = float(current_candle[1])
-        cc_high = float(current_candle[2])
-        cc_low = float(current_candle[3])
-        cc_close = float(current_candle[4])
-
-        # Candle is green
-        if (cc_open < cc_close):
-            diff = cc_high - cc_close
-            cc_wick = round((diff / cc_close) * 100, 2)
-            best_bullish_wicks.append({ 'wick': cc_wick, 'symbol': item['symbol'] })
-        else: # Candle is red
-            diff = cc_close - cc_low
-            cc_wick = -round((diff / cc_low) * 100, 2)
-            best_bearish_wicks.append({ 'wick': cc_wick, 'symbol': item['symbol'] })
-            
+SESSION_STATE_FIELDS = (
+    'times_green', 'times_red', 'last_candle_red', 'last_candle_green', 'last_low_price', 'last_high_price',
+    'stop_loss_reached', 'stop_loss', 'target_reached', 'take_profit', 'stop_loss_order_id', 'take_profit_order_id',
+    'order_filled', 'aborted',
+)
+
+class TradeSession:
+    def __init__(self, pair, quantity, interval=Intervals.DAY.value, leverage=2, market=Markets.FUTURES, side=MarketSide.LONG, limit=0, target=1):
+        self.pair = pair
+        self.quantity = quantity
+        self.interval = interval
+        self.leverage = leverage
+        self.market = market
+        self.side = side
+        self.limit = limit
+        self.target = target
+
+        self.times_green = 0
+        self.times_red = 0
+        self.last_candle_red = True
+        self.last_candle_green = True
+        self.last_low_price = 999999
+        self.last_high_price = 0
+        self.stop_loss_reached = False
+        self.stop_loss = 0
+        self.target_reached = False
+        self.take_profit = 99999 if side == MarketSide.LONG else 0
+        self.stop_loss_order_id = None
+        self.take_profit_order_id = None
+        self.order_filled = False
+        self.aborted = False
+        self.lock = threading.Lock()
+        self.latency = []
+        self.journaled_state = None
+        # Fills come from the user data stream while it is connected
+        self.order_events = False
+
+    def is_finished(self):
+        return self.aborted or self.target_reached or (self.order_filled and self.times_green >= MAX_ORDER_RETRIES)
+
+    def key(self):
+        return '{}:{}:{}:{}'.format(self.market.value, self.pair, self.interval, self.side.value)
+
+    def state(self):
+        return { field: getattr(self, field) for field in SESSION_STATE_FIELDS }
+
+    def restore(self, state):
+        for field in SESSION_STATE_FIELDS:
+            if (field in state):
+                setattr(self, field, state[field])
+
+class PaperExchange:
+    def __init__(self, slippage=PAPER_SLIPPAGE, fee=BACKTEST_FEE):
+        self.slippage = slippage
+        self.fee = fee
+        self.lock = threading.Lock()
+        self.order_ids = itertools.count(1)
+        self.prices = {}
+        self.candles = {}
+        self.positions = {}
+        self.orders = {}
+        self.open_orders = {}
+        self.sessions = {}
+        self.pnl = 0.0
+        self.fees = 0.0
+        self.fills = 0
+
+    def track(self, sessions):
+        for session in sessions:
+            self.sessions.setdefault(session.pair, []).append(session)
+            session.order_events = True
+        threading.Thread(target=self.watch, args=(lambda: all(session.is_finished() for session in sessions),), daemon=True).start()
+
+    def watch(self, is_finished):
+        # Sessions only read candles inside the trading window, brackets are checked all the time
+        while not is_finished():
+            time.sleep(SLEEP_TIMEOUT)
+            with self.lock:
+                pairs = [pair for pair, order_ids in self.open_orders.items() if order_ids and time.time() - self.prices[pair]['time'] >= SLEEP_TIMEOUT]
+            for pair in pairs:
+                try:
+                    self.update_price(pair, get_last_binance_candles(pair, '1m', Markets.FUTURES, 1)[-1], '1m')
+                except requests.RequestException:
+                    pass
+
+    def get_price(self, pair):
+        if (pair not in self.prices):
+            self.update_price(pair, get_last_binance_candles(pair, '1m', Markets.FUTURES, 1)[-1], '1m')
+        return self.prices[pair]['close']
+
+    def fill(self, pair, side, quantity, price):
+        # Called with the lock held, realized P&L on the reduced part of the position
+        position = self.positions.setdefault(pair, { 'amount': 0.0, 'entry_price': 0.0 })
+        signed_quantity = quantity if side == 'BUY' else -quantity
+        amount = position['amount']
+        if (amount * signed_quantity < 0):
+            closed = min(abs(amount), quantity)
+            self.pnl += closed * (price - position['entry_price']) * (1 if amount > 0 else -1)
+        new_amount = amount + signed_quantity
+        if (abs(new_amount) < 1e-12):
+            new_amount = 0.0
+            position['entry_price'] = 0.0
+        elif (amount * new_amount <= 0):
+            position['entry_price'] = price
+        elif (abs(new_amount) > abs(amount)):
+            position['entry_price'] = (position['entry_price'] * abs(amount) + price * quantity) / abs(new_amount)
+        position['amount'] = new_amount
+        self.fees += quantity * price * self.fee
+        self.fills += 1
+
+    def market_price(self, side, price):
+        return price * (1 + self.slippage) if side == 'BUY' else price * (1 - self.slippage)
+
+    def new_order(self, params):
+        order = {
+            'orderId': next(self.order_ids), 'symbol': params['symbol'], 'side': params['side'], 'type': params['type'],
+            'stopPrice': float(params.get('stopPrice', 0)), 'status': 'NEW', 'avgPrice': '0',
+        }
+        self.orders[order['orderId']] = order
+        return order
+
+    def place_market_order(self, params):
+        price = self.market_price(params['side'], self.get_price(params['symbol']))
+        with self.lock:
+            order = self.new_order(params)
+            quantity = float(params['quantity'])
+            if (params.get('reduceOnly') == 'true'):
+                quantity = min(quantity, abs(self.positions.get(params['symbol'], { 'amount': 0.0 })['amount']))
+            self.fill(params['symbol'], params['side'], quantity, price)
+            order.update(status='FILLED', avgPrice=str(price))
+            return dict(order)
+
+    def is_triggered(self, order, high, low):
+        # Take profits above and stop losses below the price for sells, the other way around for buys
+        if ((order['side'] == 'SELL') == (order['type'] == 'TAKE_PROFIT_MARKET')):
+            return high >= order['stopPrice']
+        return low <= order['stopPrice']
+
+    def place_stop_orders(self, orders):
+        with self.lock:
+            result = []
+            for params in orders:
+                price = self.prices.get(params['symbol'])
+                if (price is not None and self.is_triggered({ 'side': params['side'], 'type': params['type'], 'stopPrice': float(params['stopPrice']) }, price['close'], price['close'])):
+                    # Same as Binance, the position is left for the caller to close
+                    result.append({ 'code': -2021, 'msg': 'Order would immediately trigger.' })
+                    continue
+                order = self.new_order(params)
+                # Only prices reached after the order is placed trigger it
+                order['seen'] = dict(self.candles.get(params['symbol'], {}))
+                self.open_orders.setdefault(params['symbol'], set()).add(order['orderId'])
+                result.append({ key: value for key, value in order.items() if key != 'seen' })
+            return result
+
+    def cancel_orders(self, pair, order_ids):
+        with self.lock:
+            result = []
+            for order_id in order_ids:
+                if (order_id not in self.open_orders.get(pair, ())):
+                    result.append({ 'code': -2011, 'msg': 'Unknown order sent.' })
+                    continue
+                self.open_orders[pair].discard(order_id)
+                self.orders[order_id]['status'] = 'CANCELED'
+                result.append({ 'orderId': order_id, 'status': 'CANCELED' })
+            return result
+
+    def update_price(self, pair, candle, interval):
+        open_time, high, low, close = int(candle['open_time']), float(candle['high']), float(candle['low']), float(candle['close'])
+        events = []
+        with self.lock:
+            self.prices[pair] = { 'close': close, 'time': time.time() }
+            self.candles.setdefault(pair, {})[interval] = (open_time, high, low)
+            # Stop losses first when both brackets are crossed in the same update
+            for order_id in sorted(self.open_orders.get(pair, ()), key=lambda order_id: self.orders[order_id]['type'] != 'STOP_MARKET'):
+                order = self.orders[order_id]
+                reference = order['seen'].get(interval)
+                if (reference is None):
+                    seen_high = seen_low = close
+                elif (reference[0] == open_time):
+                    # Same candle, only new extremes happened after the last update
+                    seen_high = high if high > reference[1] else close
+                    seen_low = low if low < reference[2] else close
+                else:
+                    seen_high, seen_low = high, low
+                order['seen'][interval] = (open_time, high, low)
+                amount = self.positions.get(pair, { 'amount': 0.0 })['amount']
+                if (not self.is_triggered(order, seen_high, seen_low)):
+                    continue
+                self.open_orders[pair].discard(order_id)
+                if (amount == 0):
+                    order['status'] = 'EXPIRED'
+                else:
+                    # Prices gapping past the stop fill at the price seen, not at the stop
+                    if (order['side'] == 'SELL'):
+                        price = self.market_price(order['side'], min(order['stopPrice'], close))
+                    else:
+                        price = self.market_price(order['side'], max(order['stopPrice'], close))
+                    self.fill(pair, order['side'], abs(amount), price)
+                    order.update(status='FILLED', avgPrice=str(price))
+                events.append({ 's': pair, 'i': order_id, 'X': order['status'], 'ap': order['avgPrice'] })
+        for event in events:
+            ORDER_EXECUTOR.submit(self.dispatch, pair, event)
+
+    def dispatch(self, pair, event):
+        for session in self.sessions.get(pair, []):
+            with session.lock:
+                apply_order_update(session, event)
+
+    def request(self, method, endpoint, params):
+        if (endpoint == BINANCE_FUTURES_ORDER_ENDPOINT and method == 'POST'):
+            return self.place_market_order(params)
+        elif (endpoint == BINANCE_FUTURES_ORDER_ENDPOINT):
+            with self.lock:
+                return { key: value for key, value in self.orders.get(params['orderId'], { 'status': 'UNKNOWN' }).items() if key != 'seen' }
+        elif (endpoint == BINANCE_FUTURES_BATCH_ORDERS_ENDPOINT and method == 'POST'):
+            return self.place_stop_orders(json.loads(params['batchOrders']))
+        elif (endpoint == BINANCE_FUTURES_BATCH_ORDERS_ENDPOINT):
+            return self.cancel_orders(params['symbol'], json.loads(params['orderIdList']))
+        elif (endpoint == BINANCE_FUTURES_OPEN_ORDERS_ENDPOINT):
+            with self.lock:
+                return [{ 'orderId': order_id, 'type': self.orders[order_id]['type'] } for order_id in self.open_orders.get(params['symbol'], ())]
+        elif (endpoint == BINANCE_FUTURES_POSITION_RISK_ENDPOINT):
+            with self.lock:
+                return [{ 'symbol': params['symbol'], 'positionAmt': str(self.positions.get(params['symbol'], { 'amount': 0.0 })['amount']) }]
+        # Leverage and margin type
+        return {}
+
+    def summary(self):
+        with self.lock:
+            unrealized = sum(position['amount'] * (self.prices[pair]['close'] - position['entry_price']) for pair, position in self.positions.items() if position['amount'] and pair in self.prices)
+            return { 'fills': self.fills, 'pnl': self.pnl, 'fees': self.fees, 'unrealized_pnl': unrealized, 'open_positions': sum(1 for position in self.positions.values() if position['amount']) }
+
+    def print_summary(self):
+        summary = self.summary()
+        color = green if summary['pnl'] - summary['fees'] >= 0 else red
+        print(color.bold('\nPaper trading: {} fills, {:.2f} USDT P&L, {:.2f} USDT fees, {:.2f} USDT unrealized on {} open positions.'.format(
+            summary['fills'], summary['pnl'], summary['fees'], summary['unrealized_pnl'], summary['open_positions'])))
+
+class RiskEngine:
+    def __init__(self, max_exposure=None, max_symbol_margin=None, max_correlated_exposure=None):
+        self.max_exposure = max_exposure
+        self.max_symbol_margin = max_symbol_margin
+        self.max_correlated_exposure = max_correlated_exposure
+        self.lock = threading.Lock()
+        # Open positions and running totals, updated on every entry and exit
+        self.positions = {}
+        self.exposure = 0.0
+        self.symbol_margin = {}
+        self.side_exposure = {}
+        self.correlated_pairs = {}
+
+    def load_correlations(self, pairs, interval, lookback=RISK_CORRELATION_LOOKBACK, threshold=RISK_CORRELATION_THRESHOLD):
+        start_time = get_lookback_start_time(interval, lookback)
+        sync_wick_candles(pairs, interval, start_time)
+        close = load_wick_candles(pairs, interval, Markets.FUTURES, start_time)['close']
+        returns = np.diff(np.log(close), axis=1)
+        returns = returns[:, np.isfinite(returns).all(axis=0)]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            correlations = np.nan_to_num(np.atleast_2d(np.corrcoef(returns)))
+        np.fill_diagonal(correlations, 1)
+        # Pairs moving together (or against each other) are stored with the side that adds to the risk
+        correlated_pairs = {}
+        for i, pair in enumerate(pairs):
+            related = np.flatnonzero(np.abs(correlations[i]) >= threshold)
+            correlated_pairs[pair] = [(pairs[j], 1 if correlations[i, j] > 0 else -1) for j in related]
+        with self.lock:
+            self.correlated_pairs = correlated_pairs
+
+    def check(self, key, pair, sign, notional, leverage):
+        # Returns the fraction of the order allowed by the limits and the limit that scaled it.
+        # The allowed part is reserved at once, so sessions signalling together can not overshoot
+        allowed = notional
+        limit = None
+        with self.lock:
+            self.remove(key)
+            if (self.max_exposure is not None and self.max_exposure - self.exposure < allowed):
+                allowed, limit = self.max_exposure - self.exposure, 'total exposure'
+            if (self.max_symbol_margin is not None):
+                room = (self.max_symbol_margin - self.symbol_margin.get(pair, 0.0)) * leverage
+                if (room < allowed):
+                    allowed, limit = room, 'symbol margin'
+            if (self.max_correlated_exposure is not None):
+                correlated = sum(self.side_exposure.get((other, sign * relation), 0.0) for other, relation in self.correlated_pairs.get(pair, [(pair, 1)]))
+                if (self.max_correlated_exposure - correlated < allowed):
+                    allowed, limit = self.max_correlated_exposure - correlated, 'correlated exposure'
+            scale = min(max(allowed, 0.0) / notional, 1.0)
+            if (scale < RISK_MIN_SCALE):
+                return 0.0, limit
+            self.add(key, pair, sign, notional * scale, notional * scale / leverage)
+        return scale, limit
+
+    def open_position(self, key, pair, sign, notional, margin):
+        with self.lock:
+            self.remove(key)
+            self.add(key, pair, sign, notional, margin)
+
+    def add(self, key, pair, sign, notional, margin):
+        # Called with the lock held
+        self.positions[key] = (pair, sign, notional, margin)
+        self.exposure += notional
+        self.symbol_margin[pair] = self.symbol_margin.get(pair, 0.0) + margin
+        self.side_exposure[(pair, sign)] = self.side_exposure.get((pair, sign), 0.0) + notional
+
+    def close_position(self, key):
+        with self.lock:
+            self.remove(key)
+
+    def remove(self, key):
+        # Called with the lock held
+        position = self.positions.pop(key, None)
+        if (position is None):
+            return
+        pair, sign, notional, margin = position
+        self.exposure -= notional
+        self.symbol_margin[pair] -= margin
+        self.side_exposure[(pair, sign)] -= notional
+
+def observe_metric(name, value, label=''):
+    if (not METRICS_ENABLED):
+        return
+    with METRICS_LOCK:
+        histogram = METRICS_HISTOGRAMS.get((name, label))
+        if (histogram is None):
+            histogram = METRICS_HISTOGRAMS[(name, label)] = { 'buckets': [0] * (len(METRICS_BUCKETS) + 1), 'sum': 0.0, 'count': 0 }
+        histogram['buckets'][bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+def count_metric(name, value=1, label=''):
+    if (not METRICS_ENABLED):
+        return
+    with METRICS_LOCK:
+        METRICS_COUNTERS[(name, label)] = METRICS_COUNTERS.get((name, label), 0) + value
+
+def set_metric(name, value, label=''):
+    if (not METRICS_ENABLED):
+        return
+    with METRICS_LOCK:
+        METRICS_GAUGES[(name, label)] = value
+
+def format_metric_labels(label, extra=''):
+    labels = [item for item in (label, extra) if item]
+    return '{{{}}}'.format(','.join(labels)) if labels else ''
+
+def export_metrics_prometheus():
+    lines = []
+    with METRICS_LOCK:
+        for kind, metrics in (('counter', METRICS_COUNTERS), ('gauge', METRICS_GAUGES)):
+            for name in sorted({ name for name, label in metrics }):
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for (metric_name, label), value in sorted(metrics.items()):
+                    if (metric_name == name):
+                        lines.append('{}{} {}'.format(name, format_metric_labels(label), value))
+        for name in sorted({ name for name, label in METRICS_HISTOGRAMS }):
+            lines.append('# TYPE {} histogram'.format(name))
+            for (metric_name, label), histogram in sorted(METRICS_HISTOGRAMS.items()):
+                if (metric_name != name):
+                    continue
+                cumulative = 0
+                for bound, count in zip(METRICS_BUCKETS + ('+Inf',), histogram['buckets']):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, format_metric_labels(label, 'le="{}"'.format(bound)), cumulative))
+                lines.append('{}_sum{} {}'.format(name, format_metric_labels(label), histogram['sum']))
+                lines.append('{}_count{} {}'.format(name, format_metric_labels(label), histogram['count']))
+    return '\n'.join(lines) + '\n'
+
+def export_metrics_json():
+    with METRICS_LOCK:
+        return json.dumps({
+            'time': time.time(),
+            'counters': [{ 'name': name, 'labels': label, 'value': value } for (name, label), value in METRICS_COUNTERS.items()],
+            'gauges': [{ 'name': name, 'labels': label, 'value': value } for (name, label), value in METRICS_GAUGES.items()],
+            'histograms': [dict(name=name, labels=label, bounds=list(METRICS_BUCKETS), **histogram) for (name, label), histogram in METRICS_HISTOGRAMS.items()],
+        })
+
+def write_metrics():
+    if (not METRICS_ENABLED or not METRICS_FILE):
+        return
+    if (METRICS_FORMAT == 'prometheus'):
+        # Whole file is replaced, ready for a node exporter textfile collector
+        temporary_path = METRICS_FILE + '.tmp'
+        with open(temporary_path, 'w') as f:
+            f.write(export_metrics_prometheus())
+        os.replace(temporary_path, METRICS_FILE)
+    else:
+        with open(METRICS_FILE, 'a') as f:
+            f.write(export_metrics_json() + '\n')
+
+def start_metrics(metrics_file, metrics_format='json'):
+    global METRICS_ENABLED
+    global METRICS_FILE
+    global METRICS_FORMAT
+    METRICS_ENABLED = True
+    METRICS_FILE = metrics_file
+    METRICS_FORMAT = metrics_format
+
+    def write_periodically():
+        while True:
+            time.sleep(METRICS_INTERVAL)
+            write_metrics()
+
+    threading.Thread(target=write_periodically, daemon=True).start()
+    atexit.register(write_metrics)
+
+def get_http_session():
+    global HTTP_SESSION
+    if (HTTP_SESSION is None):
+        HTTP_SESSION = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=max(SCAN_CONCURRENCY, 10))
+        HTTP_SESSION.mount('https://', adapter)
+        HTTP_SESSION.mount('http://', adapter)
+    return HTTP_SESSION
+
+def get_request_weight_limit(base_url):
+    if (base_url == BINANCE_SPOT_BASE_URL):
+        return BINANCE_SPOT_WEIGHT_LIMIT
+    return BINANCE_FUTURES_WEIGHT_LIMIT
+
+def get_request_weight(endpoint, params=None):
+    if (endpoint == BINANCE_FUTURES_KLINES_ENDPOINT):
+        limit = int((params or {}).get('limit', 500))
+        if (limit < 100):
+            return 1
+        elif (limit < 500):
+            return 2
+        elif (limit <= 1000):
+            return 5
+        return 10
+    return REQUEST_WEIGHTS.get(endpoint, 1)
+
+def acquire_request_weight(base_url, weight, priority=REQUEST_PRIORITY_MARKET_DATA):
+    # Requests wait in priority order until the weight fits in this minute budget
+    budget = get_request_weight_limit(base_url) * (REQUEST_WEIGHT_ORDER_RATIO if priority == REQUEST_PRIORITY_ORDER else REQUEST_WEIGHT_BACKOFF_RATIO)
+    with REQUEST_WEIGHT_LOCK:
+        waiters = REQUEST_WEIGHT_WAITERS.setdefault(base_url, [])
+        ticket = (priority, next(REQUEST_WEIGHT_TICKETS))
+        heapq.heappush(waiters, ticket)
+        while True:
+            now = time.time()
+            minute = int(now // 60)
+            if (REQUEST_WEIGHT_MINUTE.get(base_url) != minute):
+                REQUEST_WEIGHT_MINUTE[base_url] = minute
+                REQUEST_WEIGHT_USED[base_url] = 0
+            backoff = REQUEST_WEIGHT_BACKOFF_UNTIL.get(base_url, 0) - now
+            used_weight = REQUEST_WEIGHT_USED[base_url]
+            if (backoff <= 0 and waiters[0] == ticket and (used_weight + weight <= budget or used_weight == 0)):
+                REQUEST_WEIGHT_USED[base_url] = used_weight + weight
+                heapq.heappop(waiters)
+                REQUEST_WEIGHT_LOCK.notify_all()
+                return
+            REQUEST_WEIGHT_LOCK.wait(backoff if backoff > 0 else 60 - now % 60)
+
+def update_request_weight(base_url, response):
+    used_weight = response.headers.get('X-MBX-USED-WEIGHT-1M') or response.headers.get('X-MBX-USED-WEIGHT')
+    with REQUEST_WEIGHT_LOCK:
+        if (used_weight is not None and REQUEST_WEIGHT_MINUTE.get(base_url) == int(time.time() // 60)):
+            # Other processes on the same IP count too, in flight requests are not in the header yet
+            REQUEST_WEIGHT_USED[base_url] = max(REQUEST_WEIGHT_USED.get(base_url, 0), int(used_weight))
+        if (response.status_code in (418, 429)):
+            retry_after = int(response.headers.get('Retry-After', 60))
+            REQUEST_WEIGHT_BACKOFF_UNTIL[base_url] = time.time() + retry_after
+        REQUEST_WEIGHT_LOCK.notify_all()
+
+def sign_request(params):
+    query = urlencode(dict(params or {}, timestamp=int(time.time() * 1000), recvWindow=BINANCE_RECV_WINDOW))
+    signature = hmac.new(SECRET_KEY.encode(), query.encode(), hashlib.sha256).hexdigest()
+    return '{}&signature={}'.format(query, signature)
+
+def send_binance_request(method, base_url, endpoint, params=None, signed=False, api_key=False):
+    headers = { 'X-MBX-APIKEY': API_KEY } if (signed or api_key) else None
+    # Account and order requests go before market data
+    priority = REQUEST_PRIORITY_ORDER if (signed or api_key) else REQUEST_PRIORITY_MARKET_DATA
+    weight = get_request_weight(endpoint, params)
+    while True:
+        acquire_request_weight(base_url, weight, priority)
+        # Signature includes the timestamp, it is computed again on every retry
+        query = sign_request(params) if signed else params
+        if (METRICS_ENABLED):
+            request_start = time.perf_counter()
+        response = get_http_session().request(method, base_url + endpoint, params=query, headers=headers, timeout=HTTP_TIMEOUT)
+        if (METRICS_ENABLED):
+            label = 'endpoint="{}"'.format(endpoint)
+            observe_metric('binance_request_seconds', time.perf_counter() - request_start, label)
+            count_metric('binance_requests_total', 1, '{},status="{}"'.format(label, response.status_code))
+            used_weight = response.headers.get('X-MBX-USED-WEIGHT-1M')
+            if (used_weight is not None):
+                set_metric('binance_used_weight_1m', int(used_weight), 'host="{}"'.format(base_url))
+        update_request_weight(base_url, response)
+        if (response.status_code == 418):
+            # IP is banned, retrying only makes the ban longer
+            response.raise_for_status()
+        if (response.status_code != 429):
+            return response
+        print(red.bold('Request weight limit reached on {}, backing off {} seconds'.format(base_url, response.headers.get('Retry-After', 60))))
+
+def binance_request(method, base_url, endpoint, params=None, signed=False, api_key=False):
+    if (method != 'GET' or signed or api_key):
+        return send_binance_request(method, base_url, endpoint, params, signed, api_key)
+    # Identical market data requests in flight share one response
+    key = (base_url, endpoint, tuple(sorted((params or {}).items())))
+    with REQUESTS_IN_FLIGHT_LOCK:
+        in_flight = REQUESTS_IN_FLIGHT.get(key)
+        owner = in_flight is None
+        if (owner):
+            in_flight = REQUESTS_IN_FLIGHT[key] = Future()
+    if (not owner):
+        count_metric('binance_requests_coalesced_total', 1, 'endpoint="{}"'.format(endpoint))
+        return in_flight.result()
+    try:
+        response = send_binance_request(method, base_url, endpoint, params)
+        in_flight.set_result(response)
+        return response
+    except Exception as e:
+        in_flight.set_exception(e)
+        raise
+    finally:
+        with REQUESTS_IN_FLIGHT_LOCK:
+            del REQUESTS_IN_FLIGHT[key]
+
+def binance_get(base_url, endpoint, params=None):
+    return binance_request('GET', base_url, endpoint, params)
+
+def futures_signed_request(method, endpoint, params):
+    if (PAPER_EXCHANGE is not None):
+        return PAPER_EXCHANGE.request(method, endpoint, params)
+    response = binance_request(method, BINANCE_FUTURES_BASE_URL, endpoint, params, signed=True)
+    if (response.status_code >= 400):
+        raise requests.HTTPError('{} {}: {}'.format(method, endpoint, response.text), response=response)
+    return response.json()
+
+def futures_listen_key_request(method, params=None):
+    response = binance_request(method, BINANCE_FUTURES_BASE_URL, BINANCE_FUTURES_LISTEN_KEY_ENDPOINT, params, api_key=True)
+    if (response.status_code >= 400):
+        raise requests.HTTPError('{} {}: {}'.format(method, BINANCE_FUTURES_LISTEN_KEY_ENDPOINT, response.text), response=response)
+    return response.json()
+
+def download_exchange_info(market=Markets.FUTURES):
+    if (market == Markets.SPOT):
+        response = binance_get(BINANCE_SPOT_BASE_URL, BINANCE_SPOT_EXCHANGE_INFO_ENDPOINT)
+        fields = ['status', 'baseAssetPrecision']
+    else:
+        response = binance_get(BINANCE_FUTURES_BASE_URL, BINANCE_FUTURES_EXCHANGE_INFO_ENDPOINT)
+        fields = ['status', 'contractType', 'quantityPrecision', 'pricePrecision']
+    symbols = { item['symbol']: { field: item.get(field) for field in fields } for item in response.json()['symbols'] }
+    return { 'updated': time.time(), 'symbols': symbols }
+
+def save_exchange_info():
+    with EXCHANGE_INFO_LOCK:
+        cache = dict(EXCHANGE_INFO)
+    temporary_path = '{}.{}.tmp'.format(EXCHANGE_INFO_CACHE_PATH, threading.get_ident())
+    with open(temporary_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(temporary_path, EXCHANGE_INFO_CACHE_PATH)
+
+def refresh_exchange_info(market=Markets.FUTURES):
+    try:
+        exchange_info = download_exchange_info(market)
+        with EXCHANGE_INFO_LOCK:
+            EXCHANGE_INFO[market.value] = exchange_info
+        save_exchange_info()
+    except Exception as e:
+        print(red('Could not refresh {} exchange info: {}'.format(market, e)))
+    finally:
+        with EXCHANGE_INFO_LOCK:
+            EXCHANGE_INFO_REFRESHING.discard(market.value)
+
+def get_exchange_info(market=Markets.FUTURES):
+    with EXCHANGE_INFO_LOCK:
+        exchange_info = EXCHANGE_INFO.get(market.value)
+    if (exchange_info is None):
+        # First use, read it from disk or download it
+        try:
+            with open(EXCHANGE_INFO_CACHE_PATH) as f:
+                exchange_info = json.load(f).get(market.value)
+        except (OSError, ValueError):
+            exchange_info = None
+        if (exchange_info is None):
+            exchange_info = download_exchange_info(market)
+            with EXCHANGE_INFO_LOCK:
+                EXCHANGE_INFO[market.value] = exchange_info
+            save_exchange_info()
+        else:
+            with EXCHANGE_INFO_LOCK:
+                EXCHANGE_INFO[market.value] = exchange_info
+
+    if (time.time() - exchange_info['updated'] > EXCHANGE_INFO_TTL):
+        # Keep answering with the expired info while the new one is downloaded
+        with EXCHANGE_INFO_LOCK:
+            refreshing = market.value in EXCHANGE_INFO_REFRESHING
+            EXCHANGE_INFO_REFRESHING.add(market.value)
+        if (not refreshing):
+            threading.Thread(target=refresh_exchange_info, args=(market,), daemon=True).start()
+    return exchange_info['symbols']
+
+def get_symbol_info(pair, market=Markets.FUTURES):
+    symbols = get_exchange_info(market)
+    if (pair not in symbols):
+        # Listed after the cached exchange info was downloaded
+        refresh_exchange_info(market)
+        symbols = get_exchange_info(market)
+    if (pair not in symbols):
+        print(red.bold('\n{} is not listed in Binance {} exchange info, aborting!.'.format(pair, market.value)))
+        sys.exit(1)
+    return symbols[pair]
+
+def get_lookback_start_time(interval, lookback):
+    now = int(time.time() * 1000)
+    return get_interval_time(get_interval_index(now, interval) - lookback, interval)
+
+def sync_interval_candles(pair, interval, market=Markets.FUTURES, start_time=0):
+    source = get_source_interval(interval)
+    if (source != interval):
+        start_time = get_interval_open_time(start_time, interval)
+    sync_binance_candles(pair, source, market, start_time=start_time)
+
+def read_interval_candles(pair, interval, market=Markets.FUTURES, start_time=0):
+    source = get_source_interval(interval)
+    if (source == interval):
+        return read_binance_candles(pair, interval, market, start_time=start_time)
+    # Start on a bucket boundary so the first synthesized candle is complete
+    start_time = get_interval_open_time(start_time, interval)
+    return aggregate_candles(read_binance_candles(pair, source, market, start_time=start_time), interval)
+
+def load_wick_candles(symbols, interval, market, start_time):
+    # (symbol, candle) matrices aligned on open time, missing candles are NaN
+    first = get_interval_index(start_time, interval)
+    columns = get_interval_index(int(time.time() * 1000), interval) - first + 1
+    candles = { field: np.full((len(symbols), columns), np.nan) for field in ('open', 'high', 'low', 'close') }
+    for row, symbol in enumerate(symbols):
+        symbol_candles = read_interval_candles(symbol, interval, market, start_time)
+        column = get_interval_index(symbol_candles['open_time'], interval) - first
+        keep = (column >= 0) & (column < columns)
+        for field in ('open', 'high', 'low', 'close'):
+            candles[field][row, column[keep]] = symbol_candles[field][keep]
+    return candles
+
+def top_indexes(score, top):
+    # Unordered top-k with argpartition, only the k winners get sorted
+    valid = np.count_nonzero(np.isfinite(score))
+    top = min(top, valid)
+    if (top == 0):
+        return np.array([], dtype=np.int64)
+    indexes = np.argpartition(-score, top - 1)[:top]
+    return indexes[np.argsort(-score[indexes], kind='stable')]
+
+def wick_stats(candles):
+    cc_open, cc_high, cc_low, cc_close = candles['open'], candles['high'], candles['low'], candles['close']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bullish = cc_open < cc_close
+        # Upper wick of green candles, lower wick (negative) of red candles
+        wick = np.round(np.where(bullish, (cc_high - cc_close) / cc_close, -(cc_close - cc_low) / cc_low) * 100, 2)
+
+        # Closed candles: how often the next candle retraces to each fib level of the wick
+        body_top = np.maximum(cc_open, cc_close)[:, :-1]
+        body_bottom = np.minimum(cc_open, cc_close)[:, :-1]
+        ratios = np.array(FIB_RETRACEMENT_LEVELS)[:, None, None]
+        bullish_hits = cc_high[None, :, 1:] >= body_top + ratios * (cc_high[:, :-1] - body_top)
+        bearish_hits = cc_low[None, :, 1:] <= body_bottom + ratios * (cc_low[:, :-1] - body_bottom)
+        closed = np.isfinite(wick[:, :-1]) & np.isfinite(cc_close[:, 1:])
+        closed_bullish = closed & bullish[:, :-1]
+        closed_bearish = closed & ~bullish[:, :-1]
+        return {
+            'wick': wick[:, -1],
+            'bullish': bullish[:, -1] & np.isfinite(wick[:, -1]),
+            'bearish': ~bullish[:, -1] & np.isfinite(wick[:, -1]),
+            'average_bullish_wick': np.where(closed_bullish, wick[:, :-1], 0).sum(axis=1) / closed_bullish.sum(axis=1),
+            'average_bearish_wick': np.where(closed_bearish, wick[:, :-1], 0).sum(axis=1) / closed_bearish.sum(axis=1),
+            'bullish_retracements': (bullish_hits & closed_bullish).sum(axis=2) / closed_bullish.sum(axis=1) * 100,
+            'bearish_retracements': (bearish_hits & closed_bearish).sum(axis=2) / closed_bearish.sum(axis=1) * 100,
+        }
+
+def update_wick_stats(stats, rows, row_stats):
+    for name, values in row_stats.items():
+        if (values.ndim == 2):
+            stats[name][:, rows] = values
+        else:
+            stats[name][rows] = values
+
+def select_wicks(symbols, stats, top=WICK_TOP_RESULTS):
+    def describe(indexes, side):
+        return [{
+            'symbol': symbols[i],
+            'wick': float(stats['wick'][i]),
+            'average_wick': float(stats['average_{}_wick'.format(side)][i]),
+            'retracements': { level: float(stats['{}_retracements'.format(side)][level - 1, i]) for level in range(1, len(FIB_RETRACEMENT_LEVELS) + 1) },
+        } for i in indexes]
+
+    return {
+        'bullish': describe(top_indexes(np.where(stats['bullish'], stats['wick'], -np.inf), top), 'bullish'),
+        'bearish': describe(top_indexes(np.where(stats['bearish'], -stats['wick'], -np.inf), top), 'bearish'),
+    }
+
+def finite_json(value):
+    # Averages and rates without closed candles are NaN, which is not valid JSON
+    if (isinstance(value, dict)):
+        return { key: finite_json(item) for key, item in value.items() }
+    if (isinstance(value, list)):
+        return [finite_json(item) for item in value]
+    if (isinstance(value, float) and not np.isfinite(value)):
+        return None
+    return value
+
+def rank_wicks(symbols, candles, top=WICK_TOP_RESULTS):
+    return select_wicks(symbols, wick_stats(candles), top)
+
+def sync_wick_candles(symbols, interval, start_time, concurrency=SCAN_CONCURRENCY):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        scans = { executor.submit(sync_interval_candles, symbol, interval, Markets.FUTURES, start_time): symbol for symbol in symbols }
+        for scan in as_completed(scans):
+            try:
+                scan.result()
+            except Exception as e:
+                print(red('\t x Could not check {}: {}'.format(scans[scan], e)))
+                continue
+            print('\t * Checked: {}'.format(scans[scan]))
+
+def get_perpetual_symbols():
+    exchange_info = get_exchange_info(Markets.FUTURES)
+    return [symbol for symbol, item in exchange_info.items() if item['contractType'] == 'PERPETUAL']
+
+def check_best_trade(interval=Intervals.DAY, concurrency=SCAN_CONCURRENCY, lookback=WICK_LOOKBACK, top=WICK_TOP_RESULTS):
+    symbols = get_perpetual_symbols()
+    print('Number of pairs to check approx: ', len(symbols))
+    start_time = get_lookback_start_time(interval, lookback)
+    scan_start = time.perf_counter()
+    sync_wick_candles(symbols, interval, start_time, concurrency)
+    scan_time = time.perf_counter() - scan_start
+
+    rank_start = time.perf_counter()
+    ranking = rank_wicks(symbols, load_wick_candles(symbols, interval, Markets.FUTURES, start_time), top)
+    rank_time = time.perf_counter() - rank_start
 
-    bullish_result = sorted(best_bullish_wicks, key=lambda k: k['wick'], reverse=True)
-    bearish_result = sorted(best_bearish_wicks, key=lambda k: k['wick'], reverse=False)
-    
     print(white.bold('Best bullish wicks to trade found are:'))
-    for item in bullish_result[0:10]:
-        print(green.bold('\t{} -> {} % wick.'.format(item['symbol'], item['wick'])))
+    for item in ranking['bullish']:
+        print(green.bold('\t{} -> {} % wick, {:.2f} % average, retraced to fib 1-4: {}.'.format(
+            item['symbol'], item['wick'], item['average_wick'], ' / '.join('{:.0f}%'.format(rate) for rate in item['retracements'].values()))))
 
     print(white.bold('Best bearish wicks to trade found are:'))
-    for item in bearish_result[0:10]:
-        print(red.bold('\t{} -> {} % wick.'.format(item['symbol'], item['wick'])))
+    for item in ranking['bearish']:
+        print(red.bold('\t{} -> {} % wick, {:.2f} % average, retraced to fib 1-4: {}.'.format(
+            item['symbol'], item['wick'], item['average_wick'], ' / '.join('{:.0f}%'.format(rate) for rate in item['retracements'].values()))))
+
+    print(yellow('\nScanned {} pairs in {:.2f} seconds with {} concurrent requests, ranked {} candles in {:.3f} seconds.'.format(len(symbols), scan_time, concurrency, lookback + 1, rank_time)))
+    return scan_time
+
+def run_screener(interval, lookback=WICK_LOOKBACK, top=WICK_TOP_RESULTS, concurrency=SCAN_CONCURRENCY, port=None, output=None):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    market = Markets.FUTURES
+    source = get_source_interval(interval)
+    symbols = get_perpetual_symbols()
+    print(white.bold('\n* Screening {} pairs on {} candles, top {} wicks.'.format(len(symbols), interval, top)))
+    start_time = get_lookback_start_time(interval, lookback)
+    sync_wick_candles(symbols, interval, start_time, concurrency)
+
+    # Rolling (symbol, candle) state, only rows of updated symbols are recomputed
+    lock = threading.Lock()
+    candles = load_wick_candles(symbols, interval, market, start_time)
+    stats = wick_stats(candles)
+    state = { 'open_time': get_interval_open_time(int(time.time() * 1000), interval), 'dirty': set(), 'snapshot': None }
+    synthesized = {}
+    if (source != interval):
+        for symbol in symbols:
+            synthesized[symbol] = load_synthesized_candles(symbol, interval, market, False)[1]
+    rows = { symbol: row for row, symbol in enumerate(symbols) }
+    stream_rows = { get_kline_stream_name(symbol, source, market): row for row, symbol in enumerate(symbols) }
+
+    def roll(open_time):
+        shift = get_interval_index(open_time, interval) - get_interval_index(state['open_time'], interval)
+        if (shift <= 0):
+            return
+        for values in candles.values():
+            if (shift >= values.shape[1]):
+                values[:] = np.nan
+            else:
+                values[:, :-shift] = values[:, shift:]
+                values[:, -shift:] = np.nan
+        state['open_time'] = open_time
+        # Closed candle statistics change for every pair
+        state['dirty'] = set(range(len(symbols)))
+
+    def on_message(ws, message):
+        message = loads_json(message)
+        row = stream_rows.get(message['stream'])
+        if (row is None):
+            return
+        stream_candles, closed = parse_stream_kline(message['data'])
+        if (closed):
+            save_binance_candles(symbols[row], source, market, stream_candles)
+        candle = stream_candles[0]
+        if (source == interval):
+            open_time, values = int(candle['open_time']), candle[['open', 'high', 'low', 'close']].item()
+        else:
+            synthesized[symbols[row]] = update_synthesized_candle(synthesized[symbols[row]], candle, interval)
+            open_time, values = synthesized[symbols[row]]['open_time'], synthesized_candle_row(synthesized[symbols[row]], interval)[1:5]
+        with lock:
+            if (open_time > state['open_time']):
+                roll(open_time)
+            column = get_interval_index(open_time, interval) - get_interval_index(state['open_time'], interval) - 1
+            if (-column > candles['open'].shape[1]):
+                return
+            for field, value in zip(('open', 'high', 'low', 'close'), values):
+                candles[field][row, column] = value
+            state['dirty'].add(row)
+
+    def reload_chunk(chunk):
+        # Candles closed while disconnected come from the REST API, the window is moved to the current candle first
+        with lock:
+            open_time = get_interval_open_time(int(time.time() * 1000), interval)
+            if (open_time > state['open_time']):
+                roll(open_time)
+            chunk_start_time = get_interval_time(get_interval_index(state['open_time'], interval) - (candles['open'].shape[1] - 1), interval)
+        sync_wick_candles(chunk, interval, chunk_start_time, concurrency)
+        for symbol in chunk:
+            if (source != interval):
+                synthesized[symbol] = load_synthesized_candles(symbol, interval, market, False)[1]
+        chunk_candles = load_wick_candles(chunk, interval, market, chunk_start_time)
+        chunk_rows = [rows[symbol] for symbol in chunk]
+        with lock:
+            if (get_interval_time(get_interval_index(state['open_time'], interval) - (candles['open'].shape[1] - 1), interval) == chunk_start_time):
+                for field, values in chunk_candles.items():
+                    # A candle opened while loading adds a column not in the window yet
+                    candles[field][chunk_rows] = values[:, :candles[field].shape[1]]
+            state['dirty'].update(chunk_rows)
+
+    def stream_chunk(chunk):
+        connected = [False]
+
+        def on_open(ws):
+            if (connected[0]):
+                reload_chunk(chunk)
+            connected[0] = True
+            print(yellow('\nConnected to {} kline streams.'.format(len(chunk))))
+
+        url = get_kline_stream_url([get_kline_stream_name(symbol, source, market) for symbol in chunk], market)
+        run_kline_stream(url, on_open, on_message, lambda: False)
+
+    class ScreenerHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            body = json.dumps(state['snapshot']).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    for i in range(0, len(symbols), SCREENER_STREAMS_PER_CONNECTION):
+        threading.Thread(target=stream_chunk, args=(symbols[i:i + SCREENER_STREAMS_PER_CONNECTION],), daemon=True).start()
+    if (port is not None):
+        server = ThreadingHTTPServer(('127.0.0.1', port), ScreenerHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(yellow('Serving top wicks on http://127.0.0.1:{}/'.format(server.server_address[1])))
+
+    leaders = None
+    while True:
+        with lock:
+            dirty = sorted(state['dirty'])
+            state['dirty'] = set()
+            dirty_candles = { field: values[dirty] for field, values in candles.items() }
+        if (dirty):
+            update_wick_stats(stats, dirty, wick_stats(dirty_candles))
+        ranking = select_wicks(symbols, stats, top)
+        state['snapshot'] = { 'time': int(time.time() * 1000), 'interval': interval, 'open_time': state['open_time'], 'updated': len(dirty), 'bullish': finite_json(ranking['bullish']), 'bearish': finite_json(ranking['bearish']) }
+        if (output):
+            temporary_path = '{}.tmp'.format(output)
+            with open(temporary_path, 'w') as f:
+                json.dump(state['snapshot'], f)
+            os.replace(temporary_path, output)
+        current_leaders = ([item['symbol'] for item in ranking['bullish']], [item['symbol'] for item in ranking['bearish']])
+        if (current_leaders != leaders):
+            leaders = current_leaders
+            print(white.bold('{} top wicks -> bullish: {} | bearish: {}'.format(datetime.utcnow().strftime('%H:%M:%S'),
+                ', '.join('{} {}%'.format(item['symbol'], item['wick']) for item in ranking['bullish']),
+                ', '.join('{} {}%'.format(item['symbol'], item['wick']) for item in ranking['bearish']))))
+        time.sleep(SCREENER_UPDATE_INTERVAL)
+
+def is_trading_window(now):
+    return now.hour >= START_INTERVAL and now.hour <= END_INTERVAL
 
 def check_open_trade_ready():
     global INITIAL_DELAY
     now = datetime.utcnow()
-    hour_check = now.hour >= START_INTERVAL and now.hour <= END_INTERVAL
+    hour_check = is_trading_window(now)
     if (hour_check):
         print(yellow("\nChecking candle open: {} -> {}.".format(now.strftime('%B %d %Y - %H:%M:%S'), hour_check)))
         if (not INITIAL_DELAY):
@@ -187,47 +1165,67 @@ def check_open_trade_ready():
         print(yellow("\nChecking candle open: {} -> {}. Checking again in {} seconds.".format(now.strftime('%B %d %Y - %H:%M:%S'), hour_check, SLEEP_TIMEOUT)))
     return hour_check
 
-def open_position_binance_futures(pair, take_profit, stop_loss, pair_change, quantity, leverage, side):
-    global STOP_LOSS
-    global TARGET
-    global STOP_LOSS_REACHED
-    global STOP_LOSS_ORDER_ID
-    global TAKE_PROFIT_ORDER_ID
-
-    request_client = RequestClient(api_key=API_KEY, secret_key=SECRET_KEY)
-    # Cancel previous take profit and stop loss orders
+def prepare_futures_session(session):
     try:
-        if (TAKE_PROFIT_ORDER_ID):
-            request_client.cancel_order(symbol=pair, orderId=TAKE_PROFIT_ORDER_ID)
-    except:
-        print(red.bold('Take profit order id {} could not be cancelled'.format(TAKE_PROFIT_ORDER_ID)))
+        futures_signed_request('POST', BINANCE_FUTURES_LEVERAGE_ENDPOINT, { 'symbol': session.pair, 'leverage': session.leverage })
+    except requests.RequestException:
+        print(red.bold('error changing leverage'))
 
     try:
-        if (STOP_LOSS_ORDER_ID):
-            request_client.cancel_order(symbol=pair, orderId=STOP_LOSS_ORDER_ID)
-    except:
-        print(red.bold('Stop loss profit order id {} could not be cancelled'.format(STOP_LOSS_ORDER_ID)))
-
-    STOP_LOSS_ORDER_ID = None
-    TAKE_PROFIT_ORDER_ID = None
-    # Change leverage
+        futures_signed_request('POST', BINANCE_FUTURES_MARGIN_TYPE_ENDPOINT, { 'symbol': session.pair, 'marginType': 'ISOLATED' })
+    except requests.RequestException as e:
+        # -4046: margin type is already isolated
+        if (e.response is None or '-4046' not in e.response.text):
+            print(red.bold('error changing margin type'))
+
+def keep_connection_warm(base_url, endpoint, is_finished):
+    # Idle keep-alive connections get closed, ping so the order connection stays open
+    while not is_finished():
+        try:
+            binance_get(base_url, endpoint)
+        except requests.RequestException:
+            pass
+        time.sleep(HTTP_KEEP_ALIVE_INTERVAL)
+
+def place_bracket_orders(pair, close_side, stop_loss, take_profit):
+    # Take profit and stop loss go out together in one batch
+    brackets = [
+        { 'symbol': pair, 'side': close_side, 'type': 'STOP_MARKET', 'stopPrice': stop_loss, 'closePosition': 'true', 'positionSide': 'BOTH', 'timeInForce': 'GTC' },
+        { 'symbol': pair, 'side': close_side, 'type': 'TAKE_PROFIT_MARKET', 'stopPrice': take_profit, 'closePosition': 'true', 'positionSide': 'BOTH', 'timeInForce': 'GTC' },
+    ]
     try:
-        request_client.change_initial_leverage(pair, leverage)
-    except:
-        print(red.bold('error changing leverage'))
+        return futures_signed_request('POST', BINANCE_FUTURES_BATCH_ORDERS_ENDPOINT, { 'batchOrders': json.dumps(brackets, separators=(',', ':')) })
+    except requests.RequestException as e:
+        return { 'code': -1, 'msg': str(e) }, { 'code': -1, 'msg': str(e) }
 
+def cancel_bracket_orders(pair, order_ids):
     try:
-        margin_type = request_client.change_margin_type(symbol=pair, marginType=FuturesMarginType.ISOLATED)
-    except:
-        print(red.bold('error changing margin type'))
-    
-    # Request info of all symbols to retrieve precision
-    exchange_info = request_client.get_exchange_information()
-    price_precision = 0
-    for item in exchange_info.symbols:
-        if (item.symbol == pair):
-            precision = item.quantityPrecision
-            price_precision = item.pricePrecision
+        results = futures_signed_request('DELETE', BINANCE_FUTURES_BATCH_ORDERS_ENDPOINT, { 'symbol': pair, 'orderIdList': json.dumps(order_ids, separators=(',', ':')) })
+        for order_id, result in zip(order_ids, results):
+            if ('code' in result):
+                print(red.bold('Order id {} could not be cancelled'.format(order_id)))
+    except requests.RequestException:
+        print(red.bold('Orders {} could not be cancelled'.format(order_ids)))
+
+def open_position_binance_futures(session, take_profit, stop_loss, pair_change, quantity=None):
+    latency = { 'signal': time.perf_counter() }
+    pair = session.pair
+    quantity = session.quantity if quantity is None else quantity
+    leverage = session.leverage
+    side = session.side
+
+    # Previous take profit and stop loss orders are cancelled while the new position is opened
+    previous_orders = [order_id for order_id in (session.take_profit_order_id, session.stop_loss_order_id) if order_id]
+    cancellation = None
+    if (previous_orders):
+        cancellation = ORDER_EXECUTOR.submit(cancel_bracket_orders, pair, previous_orders)
+    session.stop_loss_order_id = None
+    session.take_profit_order_id = None
+
+    # Leverage and margin type were set up in prepare_session, precisions are cached
+    symbol_info = get_symbol_info(pair, Markets.FUTURES)
+    precision = symbol_info['quantityPrecision']
+    price_precision = symbol_info['pricePrecision']
 
     # Create order
     quantity_rounded = float(quantity * leverage) / float(pair_change)
@@ -236,45 +1234,63 @@ def open_position_binance_futures(pair, take_profit, stop_loss, pair_change, qua
     stop_loss = "{:0.0{}f}".format(stop_loss, price_precision)
     take_profit = "{:0.0{}f}".format(take_profit, price_precision)
 
-    STOP_LOSS = stop_loss
-    STOP_LOSS_REACHED = False
+    session.stop_loss = stop_loss
+    session.stop_loss_reached = False
 
-    TARGET = take_profit
+    session.take_profit = take_profit
 
     print(white.bold('\n\tOpening future position {} at market ({}) with quantity: {} {} with take profit on: {} and stop loss: {}'.format(side, pair_change, quantity_with_precision, pair, take_profit, stop_loss)))
-    order_side = OrderSide.BUY
+    order_side = 'BUY'
+    close_side = 'SELL'
     if (side == MarketSide.SHORT):
-        order_side = OrderSide.SELL
+        order_side = 'SELL'
+        close_side = 'BUY'
 
-    result = request_client.post_order(symbol=pair, side=order_side, quantity=quantity_with_precision, ordertype=OrderType.MARKET, positionSide="BOTH")
-    orderId = result.orderId
-    print(green.bold('\n\t\t✓ Market order created.'))
+    # Recorded before the order is sent, a restart after a crash must not enter twice
+    journal_session(session, 'entering')
 
-    # Set take profit and stop loss orders
+    latency['market_sent'] = time.perf_counter()
     try:
-        order_side = OrderSide.SELL
-        if (side == MarketSide.SHORT):
-            order_side = OrderSide.BUY
-        result = request_client.post_order(symbol=pair, side=order_side, stopPrice=stop_loss, closePosition=True, ordertype=OrderType.STOP_MARKET, positionSide="BOTH", timeInForce="GTC")
-        STOP_LOSS_ORDER_ID = result.orderId
+        result = futures_signed_request('POST', BINANCE_FUTURES_ORDER_ENDPOINT, { 'symbol': pair, 'side': order_side, 'type': 'MARKET', 'quantity': quantity_with_precision, 'positionSide': 'BOTH', 'newOrderRespType': 'RESULT' })
+    except Exception:
+        # The quantity was reserved by check_trade_risk
+        release_trade_risk(session)
+        raise
+    latency['market_filled'] = time.perf_counter()
+    print(green.bold('\n\t\t✓ Market order created (filled at {}).'.format(result.get('avgPrice'))))
+
+    journal_session(session, 'entry')
+
+    stop_loss_result, take_profit_result = place_bracket_orders(pair, close_side, stop_loss, take_profit)
+    latency['brackets_placed'] = time.perf_counter()
+
+    session.stop_loss_order_id = stop_loss_result.get('orderId')
+    session.take_profit_order_id = take_profit_result.get('orderId')
+    journal_session(session, 'brackets')
+    if (session.stop_loss_order_id and session.take_profit_order_id):
         print(green.bold('\n\t\t✓ Stop market order at: {} created.'.format(stop_loss)))
-        result = request_client.post_order(symbol=pair, side=order_side, stopPrice=take_profit, closePosition=True, ordertype=OrderType.TAKE_PROFIT_MARKET, positionSide="BOTH", timeInForce="GTC")
-        TAKE_PROFIT_ORDER_ID = result.orderId
         print(green.bold('\n\t\t✓ Take profit market at: {} creted.'.format(take_profit)))
-    except:
-        # Cancel order if something did not work as expected
-        request_client.cancel_order(symbol=pair, orderId=orderId)
-        print(red.bold('\n\t\t x Something did not work as expected. Cancelling order'))
+    else:
+        # Do not leave an unprotected position if something did not work as expected
+        print(red.bold('\n\t\t x Something did not work as expected ({}). Closing position'.format(stop_loss_result.get('msg') or take_profit_result.get('msg'))))
+        created = [order_id for order_id in (session.stop_loss_order_id, session.take_profit_order_id) if order_id]
+        if (created):
+            cancel_bracket_orders(pair, created)
+        futures_signed_request('POST', BINANCE_FUTURES_ORDER_ENDPOINT, { 'symbol': pair, 'side': close_side, 'type': 'MARKET', 'quantity': quantity_with_precision, 'reduceOnly': 'true' })
+        session.stop_loss_order_id = None
+        session.take_profit_order_id = None
+        release_trade_risk(session)
+        journal_session(session, 'closed')
+
+    if (cancellation is not None):
+        cancellation.result()
+    session.latency.append(latency)
+    observe_metric('signal_to_fill_seconds', latency['market_filled'] - latency['signal'])
+    observe_metric('signal_to_brackets_seconds', latency['brackets_placed'] - latency['signal'])
+    print(yellow('\n\t\tSignal to fill: {:.1f} ms, signal to brackets: {:.1f} ms.'.format((latency['market_filled'] - latency['signal']) * 1000, (latency['brackets_placed'] - latency['signal']) * 1000)))
 
 def open_position_binance_spot(pair, limit, pair_change, quantity, side = SpotSides.BUY):
-    url = BINANCE_SPOT_BASE_URL + BINANCE_SPOT_CREATE_ORDER_ENDPOINT
-    
-    response = requests.get(BINANCE_SPOT_BASE_URL + BINANCE_SPOT_EXCHANGE_INFO_ENDPOINT)
-    exchange_info = response.json()
-    price_precision = 0
-    for item in exchange_info["symbols"]:
-        if (item["symbol"] == pair):
-            price_precision = item["baseAssetPrecision"]
+    price_precision = get_symbol_info(pair, Markets.SPOT)['baseAssetPrecision']
 
     quantity_rounded = float(quantity) / float(pair_change)
     quantity_with_precision = "{:0.0{}f}".format(quantity_rounded, price_precision)
@@ -285,7 +1301,7 @@ def open_position_binance_spot(pair, limit, pair_change, quantity, side = SpotSi
     else:
         parameters = { "symbol": pair, "side": SpotSides.SELL, "type": "STOP_LOSS", "quantity": quantity_with_precision, "stopPrice": quantity_with_precision }
     
-    response = requests.post(url, data = parameters)
+    response = binance_request('POST', BINANCE_SPOT_BASE_URL, BINANCE_SPOT_CREATE_ORDER_ENDPOINT, parameters, signed=True)
     print(response)
     print('***********')
     print(response.json())
@@ -296,78 +1312,316 @@ def open_position_binance_spot(pair, limit, pair_change, quantity, side = SpotSi
 
 def fib_retracement(min, max):
     diff = max - min
-    return { 1: min + 0.236 * diff, 2: min + 0.382 * diff, 3: min + 0.5 * diff, 4: min + 0.618 * diff}
-
-
-def get_last_binance_candles(pair, interval, market=Markets.FUTURES):
-    response = None
-    limit = 2
-    """if (interval == Intervals.TWO_WEEKS.value):
-        two_week_reference = datetime.utcfromtimestamp(1618185600)
-        now = datetime.utcfromtimestamp(1619433046)
-        now = datetime.utcnow()
-        diff = now - two_week_reference
-        diff_in_minutes = (diff.total_seconds() % (14 * 24 * 60 * 60)) / 60
-        diff_in_hours = diff_in_minutes / 60
-
-        next_two_week_candle = (14 * 24) - diff_in_hours
-        interval = Intervals.WEEK.value
-        limit = 3
-        if (next_two_week_candle < 24):
-            limit = 4"""
-
+    return { level: min + ratio * diff for level, ratio in enumerate(FIB_RETRACEMENT_LEVELS, 1) }
+
+
+def get_kline_store():
+    connection = getattr(KLINE_STORE, 'connection', None)
+    if (connection is None):
+        connection = sqlite3.connect(KLINE_STORE_PATH, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        # Clustered by (market, symbol, interval, open_time) so a pair history is read sequentially
+        connection.execute('''CREATE TABLE IF NOT EXISTS klines (
+            market TEXT NOT NULL,
+            symbol TEXT NOT NULL,
+            interval TEXT NOT NULL,
+            open_time INTEGER NOT NULL,
+            open REAL NOT NULL,
+            high REAL NOT NULL,
+            low REAL NOT NULL,
+            close REAL NOT NULL,
+            volume REAL NOT NULL,
+            close_time INTEGER NOT NULL,
+            trades INTEGER NOT NULL,
+            PRIMARY KEY (market, symbol, interval, open_time)
+        ) WITHOUT ROWID''')
+        KLINE_STORE.connection = connection
+    return connection
+
+def loads_json(content):
+    return orjson.loads(content) if orjson is not None else json.loads(content)
+
+def parse_binance_candles(klines):
+    # Every column is converted at once instead of float() per value in every consumer
+    candles = np.empty(len(klines), dtype=CANDLE_DTYPE)
+    if (len(klines) == 0):
+        return candles
+    columns = np.array(klines, dtype=object)[:, BINANCE_KLINE_COLUMNS]
+    for i, field in enumerate(CANDLE_DTYPE.names):
+        candles[field] = columns[:, i].astype(CANDLE_DTYPE[field])
+    return candles
+
+def fetch_binance_candles(pair, interval, market=Markets.FUTURES, limit=2, start_time=None):
     if (market == Markets.SPOT):
-        url = '{}{}?symbol={}&interval={}&limit={}'.format(BINANCE_SPOT_BASE_URL, BINANCE_SPOT_KLINES_ENDPOINT, pair, interval, limit)
-        response = requests.get(url)
+        base_url = BINANCE_SPOT_BASE_URL
+        endpoint = BINANCE_SPOT_KLINES_ENDPOINT
+        params = { 'symbol': pair, 'interval': interval, 'limit': limit }
     else:
-        response = requests.get('{}{}?pair={}&interval={}&limit={}&contractType=PERPETUAL'.format(BINANCE_FUTURES_BASE_URL, BINANCE_FUTURES_KLINES_ENDPOINT, pair, interval, limit))
-    data = response.json()
-
-    result = data
-    # Parse intervals non accepted by binance API (2w)
-    if (len(result) > 2):
-        first_week = result[0]
-        second_week = result[1]
-        third_week = result[2]
-        lc_low = min(float(first_week[3]), float(second_week[3]))
-        lc_open = float(first_week[1])
-        lc_close = float(second_week[4])
-        lc_high = max(float(first_week[2]), float(second_week[2]))
-
-        cc_low = float(third_week[3])
-        cc_open = float(third_week[1])
-        cc_close = float(third_week[4])
-        cc_high = float(third_week[2])
-
-        if (next_two_week_candle < 24):
-            fourth_week = result[3]
-            cc_low = min(float(third_week[3]), float(fourth_week[3]))
-            cc_open = float(third_week[1])
-            cc_close = float(fourth_week[4])
-            cc_high = max(float(third_week[2]), float(fourth_week[2]))
-        result = [[first_week[0], lc_open, lc_high, lc_low, lc_close], [third_week[0], cc_open, cc_high, cc_low, cc_close]]  
-
+        base_url = BINANCE_FUTURES_BASE_URL
+        endpoint = BINANCE_FUTURES_KLINES_ENDPOINT
+        params = { 'pair': pair, 'interval': interval, 'limit': limit, 'contractType': 'PERPETUAL' }
+    if (start_time is not None):
+        params['startTime'] = start_time
+    return parse_binance_candles(loads_json(binance_get(base_url, endpoint, params).content))
+
+def save_binance_candles(pair, interval, market, candles):
+    store = get_kline_store()
+    key = (market.value, pair, interval)
+    rows = [key + candle for candle in candles.tolist()]
+    with store:
+        store.executemany('INSERT OR REPLACE INTO klines VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+def download_binance_candles(pair, interval, market, start_time, end_time=None):
+    next_open_time = start_time
+    while True:
+        # Ask only for the missing candles, kline weight grows with the limit
+        until = end_time if end_time is not None else time.time() * 1000
+        missing = int((until - next_open_time) // INTERVAL_MILLISECONDS.get(interval, 1)) + 1
+        limit = max(1, min(missing, BINANCE_KLINES_MAX_LIMIT))
+        candles = fetch_binance_candles(pair, interval, market, limit, next_open_time)
+        save_binance_candles(pair, interval, market, candles)
+        if (limit < BINANCE_KLINES_MAX_LIMIT or len(candles) < limit):
+            return
+        next_open_time = int(candles['open_time'][-1]) + 1
+
+def sync_binance_candles(pair, interval, market=Markets.FUTURES, limit=2, start_time=None):
+    store = get_kline_store()
+    row = store.execute('SELECT MIN(open_time), MAX(open_time) FROM klines WHERE market = ? AND symbol = ? AND interval = ?', (market.value, pair, interval)).fetchone()
+    first_open_time, last_open_time = row
+    if (last_open_time is None and start_time is None):
+        # Nothing stored yet, just download the last candles needed
+        save_binance_candles(pair, interval, market, fetch_binance_candles(pair, interval, market, limit))
+        return
+
+    if (last_open_time is None):
+        download_binance_candles(pair, interval, market, start_time)
+        return
+
+    if (start_time is not None and start_time < first_open_time):
+        # Backfill history older than what is stored
+        download_binance_candles(pair, interval, market, start_time, first_open_time - 1)
+
+    # Last stored candle may still be open, download again from it to close it
+    download_binance_candles(pair, interval, market, last_open_time)
+
+def read_binance_candles(pair, interval, market=Markets.FUTURES, limit=None, start_time=0):
+    store = get_kline_store()
+    query = 'SELECT open_time, open, high, low, close, volume, close_time, trades FROM klines WHERE market = ? AND symbol = ? AND interval = ? AND open_time >= ? ORDER BY open_time DESC'
+    parameters = (market.value, pair, interval, start_time)
+    if (limit is not None):
+        query += ' LIMIT ?'
+        parameters += (limit,)
+    rows = store.execute(query, parameters).fetchall()
+    rows.reverse()
+    return np.array(rows, dtype=CANDLE_DTYPE)
+
+def get_source_interval(interval):
+    if (BASE_INTERVAL and interval != BASE_INTERVAL and interval not in NATIVE_ONLY_INTERVALS and INTERVAL_MILLISECONDS[interval] % INTERVAL_MILLISECONDS[BASE_INTERVAL] == 0):
+        return BASE_INTERVAL
+    return SYNTHESIZED_INTERVALS.get(interval, interval)
+
+def get_interval_index(open_time, interval):
+    # Monthly candles open on calendar months, every other interval has a fixed period
+    if (interval == '1M'):
+        index = np.asarray(open_time, dtype=np.int64).astype('datetime64[ms]').astype('datetime64[M]').astype(np.int64)
+        return index if index.ndim else int(index)
+    return (open_time - INTERVAL_ANCHORS.get(interval, 0)) // INTERVAL_MILLISECONDS[interval]
+
+def get_interval_time(index, interval):
+    if (interval == '1M'):
+        return int(np.datetime64(index, 'M').astype('datetime64[ms]').astype(np.int64))
+    return INTERVAL_ANCHORS.get(interval, 0) + index * INTERVAL_MILLISECONDS[interval]
+
+def get_interval_open_time(open_time, interval):
+    return get_interval_time(get_interval_index(open_time, interval), interval)
+
+def aggregate_candles(candles, interval):
+    if (len(candles) == 0):
+        return np.empty(0, dtype=CANDLE_DTYPE)
+    anchor = INTERVAL_ANCHORS.get(interval, 0)
+    period = INTERVAL_MILLISECONDS[interval]
+    bucket = (candles['open_time'] - anchor) // period
+    starts = np.flatnonzero(np.concatenate(([True], bucket[1:] != bucket[:-1])))
+    ends = np.concatenate((starts[1:], [len(candles)])) - 1
+    aggregated = np.empty(len(starts), dtype=CANDLE_DTYPE)
+    aggregated['open_time'] = anchor + bucket[starts] * period
+    aggregated['open'] = candles['open'][starts]
+    aggregated['high'] = np.maximum.reduceat(candles['high'], starts)
+    aggregated['low'] = np.minimum.reduceat(candles['low'], starts)
+    aggregated['close'] = candles['close'][ends]
+    aggregated['volume'] = np.add.reduceat(candles['volume'], starts)
+    aggregated['close_time'] = aggregated['open_time'] + period - 1
+    aggregated['trades'] = np.add.reduceat(candles['trades'], starts)
+    return aggregated
+
+def update_synthesized_candle(candle, base_candle, interval):
+    base_open_time, base_open, base_high, base_low, base_close, base_volume, base_close_time, base_trades = base_candle.item()
+    open_time = get_interval_open_time(base_open_time, interval)
+    if (candle is None or candle['open_time'] != open_time):
+        candle = { 'open_time': open_time, 'open': base_open, 'base_open_time': base_open_time, 'closed': (-float('inf'), float('inf'), 0.0, 0) }
+    elif (candle['base_open_time'] != base_open_time):
+        # Previous base candle is closed, fold it into the synthesized candle
+        candle['closed'] = (candle['high'], candle['low'], candle['volume'], candle['trades'])
+        candle['base_open_time'] = base_open_time
+    closed_high, closed_low, closed_volume, closed_trades = candle['closed']
+    candle['high'] = max(closed_high, base_high)
+    candle['low'] = min(closed_low, base_low)
+    candle['close'] = base_close
+    candle['volume'] = closed_volume + base_volume
+    candle['trades'] = closed_trades + base_trades
+    return candle
+
+def synthesized_candle_row(candle, interval):
+    return (candle['open_time'], candle['open'], candle['high'], candle['low'], candle['close'], candle['volume'], candle['open_time'] + INTERVAL_MILLISECONDS[interval] - 1, candle['trades'])
+
+def load_synthesized_candles(pair, interval, market=Markets.FUTURES, sync=True):
+    # Previous synthesized candle plus the running state of the current one
+    source = get_source_interval(interval)
+    current_open_time = get_interval_open_time(int(time.time() * 1000), interval)
+    start_time = current_open_time - INTERVAL_MILLISECONDS[interval]
+    if (sync):
+        sync_binance_candles(pair, source, market, start_time=start_time)
+    base_candles = read_binance_candles(pair, source, market, start_time=start_time)
+    previous = aggregate_candles(base_candles[base_candles['open_time'] < current_open_time], interval)
+    current = None
+    for base_candle in base_candles[base_candles['open_time'] >= current_open_time]:
+        current = update_synthesized_candle(current, base_candle, interval)
+    return (previous[-1] if len(previous) else None, current)
+
+def fetch_last_binance_candles(pair, interval, market=Markets.FUTURES, limit=2):
+    if (METRICS_ENABLED):
+        candles_start = time.perf_counter()
+    source = get_source_interval(interval)
+    if (source == interval):
+        sync_binance_candles(pair, interval, market, limit)
+        result = read_binance_candles(pair, interval, market, limit)
+    else:
+        # Intervals not accepted by binance API (2w) or built from --base-interval
+        now = int(time.time() * 1000)
+        start_time = get_interval_open_time(now, interval) - (limit - 1) * INTERVAL_MILLISECONDS[interval]
+        sync_binance_candles(pair, source, market, start_time=start_time)
+        result = aggregate_candles(read_binance_candles(pair, source, market, start_time=start_time), interval)[-limit:]
+    if (METRICS_ENABLED):
+        observe_metric('get_last_candles_seconds', time.perf_counter() - candles_start, 'interval="{}"'.format(interval))
     return result
 
-def check_safe_stop_loss(low, open):
+def count_kline_cache(result):
+    KLINE_CACHE_STATS[result] += 1
+    count_metric('kline_cache_requests_total', 1, 'result="{}"'.format(result))
+
+def get_kline_cache_stats():
+    with KLINE_CACHE_LOCK:
+        return dict(KLINE_CACHE_STATS, size=len(KLINE_CACHE))
+
+def lookup_kline_cache(key):
+    with KLINE_CACHE_LOCK:
+        entry = KLINE_CACHE.get(key)
+        if (entry is None or entry[0] <= time.time()):
+            return None
+        KLINE_CACHE.move_to_end(key)
+        count_kline_cache('hits')
+        return entry[1]
+
+def start_kline_fetch(key):
+    # Returns the future of the fetch and whether the caller has to run it
+    with KLINE_CACHE_LOCK:
+        future = KLINE_CACHE_IN_FLIGHT.get(key)
+        if (future is not None):
+            count_kline_cache('coalesced')
+            return future, False
+        future = KLINE_CACHE_IN_FLIGHT[key] = Future()
+        count_kline_cache('misses')
+        return future, True
+
+def fetch_cached_candles(key, future):
+    pair, interval, market, limit = key
+    try:
+        result = fetch_last_binance_candles(pair, interval, market, limit)
+        now = time.time()
+        period = INTERVAL_MILLISECONDS[interval]
+        next_open_time = (get_interval_open_time(int(now * 1000), interval) + period) / 1000
+        expires = min(now + min(period / 1000 * KLINE_CACHE_TTL_RATIO, KLINE_CACHE_MAX_TTL), next_open_time)
+        with KLINE_CACHE_LOCK:
+            KLINE_CACHE[key] = (expires, result)
+            KLINE_CACHE.move_to_end(key)
+            while len(KLINE_CACHE) > KLINE_CACHE_SIZE:
+                KLINE_CACHE.popitem(last=False)
+                count_kline_cache('evictions')
+        future.set_result(result)
+    except Exception as e:
+        future.set_exception(e)
+    finally:
+        with KLINE_CACHE_LOCK:
+            del KLINE_CACHE_IN_FLIGHT[key]
+
+def get_last_binance_candles(pair, interval, market=Markets.FUTURES, limit=2):
+    key = (pair, interval, market, limit)
+    result = lookup_kline_cache(key)
+    if (result is not None):
+        return result
+    future, owner = start_kline_fetch(key)
+    if (owner):
+        fetch_cached_candles(key, future)
+    return future.result()
+
+async def get_last_binance_candles_async(pair, interval, market=Markets.FUTURES, limit=2, executor=None):
+    import asyncio
+    key = (pair, interval, market, limit)
+    result = lookup_kline_cache(key)
+    if (result is not None):
+        return result
+    future, owner = start_kline_fetch(key)
+    if (owner):
+        asyncio.get_running_loop().run_in_executor(executor, fetch_cached_candles, key, future)
+    return await asyncio.wrap_future(future)
+
+def stop_loss_risk(low, open):
     diff = open - low
-    trade_risk = (diff / low) * 100
+    return (diff / low) * 100
+
+def check_safe_stop_loss(low, open):
+    trade_risk = stop_loss_risk(low, open)
     is_safe = MAX_STOP_LOSS_RISK > trade_risk
     print(yellow.bold('\n\t⚠ Position risk is: {}%'.format(round(trade_risk, 2))))
     if not is_safe:
         print(red.bold('\n\tTrade is too risky ({}), aborting!.'.format(trade_risk)))
-        exit(1)
     return is_safe
 
+def get_trade_sign(session):
+    return 1 if session.side == MarketSide.LONG else -1
+
+def check_trade_risk(session, low, open):
+    # Quantity allowed for the trade and reserved until the position is closed, 0 when it must not be opened
+    if (not check_safe_stop_loss(low, open)):
+        release_trade_risk(session)
+        return 0
+    if (RISK_ENGINE is None or session.market != Markets.FUTURES):
+        return session.quantity
+    scale, limit = RISK_ENGINE.check(session.key(), session.pair, get_trade_sign(session), session.quantity * session.leverage, session.leverage)
+    if (scale == 0):
+        print(red.bold('\n\t{} trade rejected, {} limit reached.'.format(session.pair, limit)))
+    elif (scale < 1):
+        print(yellow.bold('\n\t{} trade scaled to {:.0%} of its quantity, {} limit reached.'.format(session.pair, scale, limit)))
+    return session.quantity * scale
+
+def register_trade_risk(session, quantity):
+    if (RISK_ENGINE is not None):
+        RISK_ENGINE.open_position(session.key(), session.pair, get_trade_sign(session), quantity * session.leverage, quantity)
+
+def release_trade_risk(session):
+    if (RISK_ENGINE is not None):
+        RISK_ENGINE.close_position(session.key())
+
 def set_sleep_timeout(interval):
     global SLEEP_TIMEOUT
     sleep = 15
     low_tf_sleep = 3
-    """if (interval == Intervals.FIVETEEN_MINUTES.value):
+    if (interval == Intervals.FIVETEEN_MINUTES.value):
         sleep = low_tf_sleep
     elif (interval == Intervals.THIRTY_MINUTES.value):
-        sleep = low_tf_sleep"""
-    if (interval == Intervals.HOUR.value):
+        sleep = low_tf_sleep
+    elif (interval == Intervals.HOUR.value):
         sleep = low_tf_sleep
     elif (interval == Intervals.FOUR_HOURS.value):
         sleep = low_tf_sleep
@@ -380,80 +1634,56 @@ def minimum_downside(cc_open, cc_low):
     downside = (diff / cc_low) * 100
     return downside > 0.5
 
-def trade_the_open(pair, interval, quantity, leverage, market, side, limit, target):
-    global LAST_CANDLE_RED
-    global LAST_CANDLE_GREEN
-    global LAST_LOW_PRICE
-    global LAST_HIGH_PRICE
-    global TIMES_GREEN
-    global TIMES_RED
-    global TARGET
-    global TARGET_REACHED
-    global STOP_LOSS_REACHED
-    global STOP_LOSS
+def trade_the_open(session, candles=None):
+    pair = session.pair
+    interval = session.interval
+    market = session.market
+    side = session.side
 
-    try:
-        candles = get_last_binance_candles(pair, interval, market)
-    except:
-        time.sleep(SLEEP_TIMEOUT)
-        candles = get_last_binance_candles(pair, interval, market)
+    if (candles is None):
+        try:
+            candles = get_last_binance_candles(pair, interval, market)
+        except:
+            time.sleep(SLEEP_TIMEOUT)
+            candles = get_last_binance_candles(pair, interval, market)
             
-    """ Binance API response format
-    [
-        [
-            1499040000000,      // Open time
-            "0.01634790",       // Open
-            "0.80000000",       // High
-            "0.01575800",       // Low
-            "0.01577100",       // Close
-            "148976.11427815",  // Volume
-            1499644799999,      // Close time
-            "2434.19055334",    // Quote asset volume
-            308,                // Number of trades
-            "1756.87402397",    // Taker buy base asset volume
-            "28.46694368",      // Taker buy quote asset volume
-            "17928899.62484339" // Ignore.
-        ]
-    ]"""
-
-    last_candle = candles[0]
-    lc_open = float(last_candle[1])
-    lc_high = float(last_candle[2])
-    lc_low = float(last_candle[3])
-    lc_close = float(last_candle[4])
-
-    current_candle = candles[1]
-    cc_open = float(current_candle[1])
-    cc_high = float(current_candle[2])
-    cc_low = float(current_candle[3])
-    cc_close = float(current_candle[4])
+    if (PAPER_EXCHANGE is not None and market == Markets.FUTURES):
+        PAPER_EXCHANGE.update_price(pair, candles[1], interval)
+
+    lc_open, lc_high, lc_low, lc_close = candles[0][['open', 'high', 'low', 'close']].item()
+    cc_open, cc_high, cc_low, cc_close = candles[1][['open', 'high', 'low', 'close']].item()
     # Check if candlestick turned green
 
-    if (side == MarketSide.LONG):
-        if (cc_high >= float(TARGET)):
-            TARGET_REACHED = True
-    else:
-        if (cc_low <= float(TARGET)):
-            TARGET_REACHED = True
+    # Without the user data stream fills are guessed from the candle
+    if (not session.order_events):
+        if (side == MarketSide.LONG):
+            if (cc_high >= float(session.take_profit)):
+                session.target_reached = True
+        else:
+            if (cc_low <= float(session.take_profit)):
+                session.target_reached = True
+
+        if (cc_low <= float(session.stop_loss)):
+            session.stop_loss_reached = True
 
-    if (cc_low <= float(STOP_LOSS)):
-        STOP_LOSS_REACHED = True
+        if (session.target_reached or session.stop_loss_reached):
+            release_trade_risk(session)
 
-    if (TIMES_GREEN > 1 and not STOP_LOSS_REACHED):
+    if (session.times_green > 1 and not session.stop_loss_reached):
         return False
 
     # LONG trades
     if (side == MarketSide.LONG):
         if (cc_open < cc_close and cc_open >= cc_low):
-            if (LAST_CANDLE_RED and cc_low < LAST_LOW_PRICE):
-                print('***** INTENTO NUMERO: {} ******'.format(TIMES_GREEN))
-                TIMES_GREEN += 1
-                LAST_CANDLE_RED = False
-                LAST_LOW_PRICE = cc_low
+            if (session.last_candle_red and cc_low < session.last_low_price):
+                print('***** INTENTO NUMERO: {} ******'.format(session.times_green))
+                session.times_green += 1
+                session.last_candle_red = False
+                session.last_low_price = cc_low
             else:
-                print(' x - Todavia esta verde como para volver a intentarlo, target reached?: ', TARGET_REACHED, TARGET)
+                print(' x - Todavia esta verde como para volver a intentarlo, target reached?: ', session.target_reached, session.take_profit)
                 return False
-            print(green.bold('\n\tCandle turned green.'))
+            print(green.bold('\n\t{} candle turned green.'.format(pair)))
             # Check if previous candle is green or red to apply fib retracement
             if (lc_open < lc_close):
                 # Previous candle is green
@@ -465,30 +1695,33 @@ def trade_the_open(pair, interval, quantity, leverage, market, side, limit, targ
             #if (not minimum_downside(cc_open, cc_low)):
                 #return False
 
-            if (check_safe_stop_loss(cc_low, cc_open)):
+            quantity = check_trade_risk(session, cc_low, cc_open)
+            if (quantity):
                 if (market == Markets.FUTURES):
-                    open_position_binance_futures(pair, targets[target], cc_low, cc_close, quantity, leverage, side)
+                    open_position_binance_futures(session, targets[session.target], cc_low, cc_close, quantity)
                 else:
                     open_position_binance_spot(pair, cc_close, cc_close, quantity, SpotSides.BUY)
                 return True
+            session.aborted = True
+            return False
         else:
-            if not LAST_CANDLE_RED:
-                LAST_CANDLE_RED = True
-            print(yellow.bold('\t Candle is still RED after the open. Checking again in {} seconds'.format(SLEEP_TIMEOUT)))    
+            if not session.last_candle_red:
+                session.last_candle_red = True
+            print(yellow.bold('\t {} candle is still RED after the open. Checking again in {} seconds'.format(pair, SLEEP_TIMEOUT)))    
             return False
     
     else: #SHORT TRADES!
         if (cc_open > cc_close and cc_open <= cc_high):
-            print(LAST_CANDLE_GREEN, cc_high, ' < ', LAST_HIGH_PRICE)
-            if (LAST_CANDLE_GREEN and cc_high > LAST_HIGH_PRICE):
-                print('***** INTENTO NUMERO: {} ******'.format(TIMES_RED))
-                TIMES_RED += 1
-                LAST_CANDLE_GREEN = False
-                LAST_HIGH_PRICE = cc_high
+            print(session.last_candle_green, cc_high, ' < ', session.last_high_price)
+            if (session.last_candle_green and cc_high > session.last_high_price):
+                print('***** INTENTO NUMERO: {} ******'.format(session.times_red))
+                session.times_red += 1
+                session.last_candle_green = False
+                session.last_high_price = cc_high
             else:
-                print(' x - Candle still red to try again. Target reached?: ', TARGET_REACHED, TARGET)
+                print(' x - Candle still red to try again. Target reached?: ', session.target_reached, session.take_profit)
                 return False
-            print(green.bold('\n\tCandle turned red.'))
+            print(green.bold('\n\t{} candle turned red.'.format(pair)))
             # Check if previous candle is red to apply fib retracement
             if (lc_open < lc_close):
                 # Previous candle is green
@@ -499,35 +1732,894 @@ def trade_the_open(pair, interval, quantity, leverage, market, side, limit, targ
             print(white.bold('\n\tTargets based on fib retracement: {}'.format(targets)))
 
             print('COMPROBANDO SAFE SL')
-            if (check_safe_stop_loss(cc_open, cc_high)):
+            quantity = check_trade_risk(session, cc_open, cc_high)
+            if (quantity):
                 if (market == Markets.FUTURES):
                     print('ABRO SHORT')
-                    open_position_binance_futures(pair, targets[target], cc_high, cc_close, quantity, leverage, side)
+                    open_position_binance_futures(session, targets[session.target], cc_high, cc_close, quantity)
                 else:
                     open_position_binance_spot(pair, cc_close, cc_close, quantity, SpotSides.BUY)
                 return True
+            session.aborted = True
+            return False
         else:
-            if not LAST_CANDLE_GREEN:
-                LAST_CANDLE_GREEN = True
-            print(yellow.bold('\t Candle is still GREEN after the open. Checking again in {} seconds'.format(SLEEP_TIMEOUT)))    
+            if not session.last_candle_green:
+                session.last_candle_green = True
+            print(yellow.bold('\t {} candle is still GREEN after the open. Checking again in {} seconds'.format(pair, SLEEP_TIMEOUT)))    
             return False
-def main(pair, quantity, interval=Intervals.DAY, leverage=2, market=Markets.FUTURES, side=MarketSide.LONG, limit=0, target=1):
-    order_filled = False
-    global TARGET 
-    set_sleep_timeout(interval)
-    if (side == MarketSide.SHORT):
-        TARGET = 0
-
-    print(white.bold('* Liquidity trading of: {} with {} as amount at {} candle with x{} leverage and at {} market starting at {} and finishing at {}.'.format(pair, quantity, interval, leverage, market, START_INTERVAL, END_INTERVAL)))
-    while not TARGET_REACHED and (not order_filled or TIMES_GREEN < MAX_ORDER_RETRIES):
+def get_session_journal():
+    connection = getattr(SESSION_JOURNAL, 'connection', None)
+    if (connection is None):
+        connection = sqlite3.connect(SESSION_JOURNAL_PATH, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('''CREATE TABLE IF NOT EXISTS session_journal (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session TEXT NOT NULL,
+            time INTEGER NOT NULL,
+            event TEXT NOT NULL,
+            state TEXT NOT NULL
+        )''')
+        connection.execute('CREATE INDEX IF NOT EXISTS session_journal_session ON session_journal (session, id)')
+        SESSION_JOURNAL.connection = connection
+    return connection
+
+def journal_session(session, event='step'):
+    # Paper positions do not outlive the process, neither do paper sessions
+    if (PAPER_EXCHANGE is not None):
+        return
+    # Only state transitions are appended
+    state = json.dumps(session.state(), separators=(',', ':'))
+    if (state == session.journaled_state):
+        return
+    connection = get_session_journal()
+    with connection:
+        connection.execute('INSERT INTO session_journal (session, time, event, state) VALUES (?, ?, ?, ?)', (session.key(), int(time.time() * 1000), event, state))
+    session.journaled_state = state
+
+def restore_session(session):
+    if (PAPER_EXCHANGE is not None):
+        return False
+    connection = get_session_journal()
+    row = connection.execute('SELECT id, state FROM session_journal WHERE session = ? ORDER BY id DESC LIMIT 1', (session.key(),)).fetchone()
+    if (row is None):
+        return False
+    # Older transitions are not needed anymore, keep the journal compact
+    with connection:
+        connection.execute('DELETE FROM session_journal WHERE session = ? AND id < ?', (session.key(), row[0]))
+    state = json.loads(row[1])
+    if (state['aborted'] or state['target_reached'] or (state['order_filled'] and state['times_green'] >= MAX_ORDER_RETRIES)):
+        # Finished sessions are not resumed, a new one starts from scratch
+        return False
+    session.restore(state)
+    session.journaled_state = row[1]
+    print(yellow('\tRestored {} session: try {}, stop loss {}, take profit {}, orders {} / {}.'.format(session.pair, session.times_green, session.stop_loss, session.take_profit, session.stop_loss_order_id, session.take_profit_order_id)))
+    return True
+
+def get_futures_position(pair):
+    positions = futures_signed_request('GET', BINANCE_FUTURES_POSITION_RISK_ENDPOINT, { 'symbol': pair })
+    return sum(float(position['positionAmt']) for position in positions if position['symbol'] == pair)
+
+def reconcile_futures_session(session, restored):
+    pair = session.pair
+    open_orders = futures_signed_request('GET', BINANCE_FUTURES_OPEN_ORDERS_ENDPOINT, { 'symbol': pair })
+    brackets = [order['orderId'] for order in open_orders if order['type'] in BRACKET_ORDER_TYPES]
+    session_orders = [order_id for order_id in (session.stop_loss_order_id, session.take_profit_order_id) if order_id]
+    # Only orders journaled by this session are ever cancelled, other orders on the pair belong to the user or other sessions
+    session_brackets = [order_id for order_id in brackets if order_id in session_orders]
+    position = get_futures_position(pair)
+    orphans = []
+
+    if (position == 0):
+        # Position was closed while the process was down
+        if (session.take_profit_order_id and session.take_profit_order_id not in brackets):
+            order = futures_signed_request('GET', BINANCE_FUTURES_ORDER_ENDPOINT, { 'symbol': pair, 'orderId': session.take_profit_order_id })
+            session.target_reached = order.get('status') == 'FILLED'
+        if (session.stop_loss_order_id and session.stop_loss_order_id not in brackets):
+            order = futures_signed_request('GET', BINANCE_FUTURES_ORDER_ENDPOINT, { 'symbol': pair, 'orderId': session.stop_loss_order_id })
+            session.stop_loss_reached = order.get('status') == 'FILLED'
+        orphans = session_brackets
+        session.stop_loss_order_id = None
+        session.take_profit_order_id = None
+    elif (not restored or not session.stop_loss):
+        print(red.bold('\t{} has an open position of {} not opened by this session, its orders are left untouched and the session will not trade.'.format(pair, position)))
+        session.aborted = True
+    elif (any(order_id not in brackets for order_id in session_orders) or len(session_orders) < 2):
+        # Crashed between the entry and its brackets: protect the position again
+        orphans = session_brackets
+        close_side = 'SELL' if position > 0 else 'BUY'
+        stop_loss_result, take_profit_result = place_bracket_orders(pair, close_side, session.stop_loss, session.take_profit)
+        session.stop_loss_order_id = stop_loss_result.get('orderId')
+        session.take_profit_order_id = take_profit_result.get('orderId')
+        if (session.stop_loss_order_id and session.take_profit_order_id):
+            print(green.bold('\t✓ {} brackets placed again at stop loss {} and take profit {}.'.format(pair, session.stop_loss, session.take_profit)))
+        else:
+            print(red.bold('\t x {} position of {} is not protected: {}'.format(pair, position, stop_loss_result.get('msg') or take_profit_result.get('msg'))))
+
+    if (position != 0 and restored and session.stop_loss):
+        register_trade_risk(session, session.quantity)
+
+    for i in range(0, len(orphans), BINANCE_BATCH_ORDERS_MAX):
+        print(yellow('\tCancelling orphaned {} orders {}.'.format(pair, orphans[i:i + BINANCE_BATCH_ORDERS_MAX])))
+        cancel_bracket_orders(pair, orphans[i:i + BINANCE_BATCH_ORDERS_MAX])
+    journal_session(session, 'reconciled')
+
+def apply_order_update(session, order):
+    order_id = order['i']
+    if (order_id not in (session.stop_loss_order_id, session.take_profit_order_id)):
+        return
+    status = order['X']
+    if (status == 'FILLED'):
+        remaining = session.stop_loss_order_id if order_id == session.take_profit_order_id else session.take_profit_order_id
+        if (order_id == session.take_profit_order_id):
+            session.target_reached = True
+            print(green.bold('\n\t✓ {} take profit filled at {}.'.format(session.pair, order.get('ap'))))
+        else:
+            session.stop_loss_reached = True
+            print(red.bold('\n\t x {} stop loss filled at {}.'.format(session.pair, order.get('ap'))))
+        session.stop_loss_order_id = None
+        session.take_profit_order_id = None
+        release_trade_risk(session)
+        if (remaining):
+            ORDER_EXECUTOR.submit(cancel_bracket_orders, session.pair, [remaining])
+    elif (status in ('CANCELED', 'EXPIRED', 'REJECTED')):
+        print(yellow('\n\t{} order {} {}.'.format(session.pair, order_id, status.lower())))
+        if (order_id == session.stop_loss_order_id):
+            session.stop_loss_order_id = None
+        else:
+            session.take_profit_order_id = None
+    journal_session(session, 'order')
+
+def apply_position_update(session, position):
+    if (float(position['pa']) != 0):
+        return
+    release_trade_risk(session)
+    # The position update may arrive before the bracket fill, check the brackets before dropping them
+    for order_id in (session.take_profit_order_id, session.stop_loss_order_id):
+        if (not order_id or order_id not in (session.take_profit_order_id, session.stop_loss_order_id)):
+            continue
+        try:
+            order = futures_signed_request('GET', BINANCE_FUTURES_ORDER_ENDPOINT, { 'symbol': session.pair, 'orderId': order_id })
+        except requests.RequestException as e:
+            # Keep the brackets, their order events or the next reconciliation settle them
+            print(red('\n\t x Could not check {} order {}: {}'.format(session.pair, order_id, e)))
+            return
+        if (order.get('status') == 'FILLED'):
+            apply_order_update(session, { 'i': order_id, 'X': 'FILLED', 'ap': order.get('avgPrice') })
+    # Position closed outside the brackets, they would open a new one
+    remaining = [order_id for order_id in (session.stop_loss_order_id, session.take_profit_order_id) if order_id]
+    if (remaining):
+        print(yellow('\n\t{} position closed, cancelling brackets {}.'.format(session.pair, remaining)))
+        session.stop_loss_order_id = None
+        session.take_profit_order_id = None
+        ORDER_EXECUTOR.submit(cancel_bracket_orders, session.pair, remaining)
+        journal_session(session, 'position')
+
+def run_user_data_stream(sessions, is_finished):
+    import websocket
+    pair_sessions = {}
+    for session in sessions:
+        pair_sessions.setdefault(session.pair, []).append(session)
+    reconnect_delay = [STREAM_RECONNECT_DELAY]
+    connected = [False]
+
+    def set_order_events(enabled):
+        for session in sessions:
+            session.order_events = enabled
+
+    def on_open(ws):
+        if (connected[0]):
+            # Fills made while disconnected are read from the REST API
+            for session in sessions:
+                with session.lock:
+                    reconcile_futures_session(session, True)
+        connected[0] = True
+        reconnect_delay[0] = STREAM_RECONNECT_DELAY
+        set_order_events(True)
+        print(yellow('\nConnected to the user data stream.'))
+
+    def on_message(ws, message):
+        event = json.loads(message)
+        if (event.get('e') == 'ORDER_TRADE_UPDATE'):
+            for session in pair_sessions.get(event['o']['s'], []):
+                with session.lock:
+                    apply_order_update(session, event['o'])
+        elif (event.get('e') == 'ACCOUNT_UPDATE'):
+            for position in event['a'].get('P', []):
+                for session in pair_sessions.get(position['s'], []):
+                    with session.lock:
+                        apply_position_update(session, position)
+        elif (event.get('e') == 'listenKeyExpired'):
+            ws.close()
+
+    def on_error(ws, error):
+        print(red.bold('User data stream error: {}'.format(error)))
+
+    def keep_alive(ws, closed):
+        while not closed.wait(USER_DATA_KEEPALIVE_INTERVAL):
+            try:
+                futures_listen_key_request('PUT')
+            except requests.RequestException:
+                ws.close()
+
+    while not is_finished():
+        try:
+            listen_key = futures_listen_key_request('POST')['listenKey']
+        except requests.RequestException as e:
+            listen_key = None
+            print(red.bold('Could not create a listen key: {}'.format(e)))
+        if (listen_key):
+            ws = websocket.WebSocketApp('{}/ws/{}'.format(BINANCE_FUTURES_STREAM_URL, listen_key), on_open=on_open, on_message=on_message, on_error=on_error)
+            closed = threading.Event()
+            threading.Thread(target=keep_alive, args=(ws, closed), daemon=True).start()
+            ws.run_forever(ping_interval=STREAM_PING_INTERVAL)
+            closed.set()
+            set_order_events(False)
+        if (not is_finished()):
+            print(yellow('User data stream closed, reconnecting in {} seconds.'.format(reconnect_delay[0])))
+            time.sleep(reconnect_delay[0])
+            reconnect_delay[0] = min(reconnect_delay[0] * 2, STREAM_MAX_RECONNECT_DELAY)
+
+def track_orders(sessions):
+    sessions = [session for session in sessions if session.market == Markets.FUTURES]
+    if (sessions and PAPER_EXCHANGE is not None):
+        PAPER_EXCHANGE.track(sessions)
+    elif (sessions):
+        threading.Thread(target=run_user_data_stream, args=(sessions, lambda: all(session.is_finished() for session in sessions)), daemon=True).start()
+
+def prepare_session(session):
+    # Everything an order needs is loaded before the first signal
+    get_symbol_info(session.pair, session.market)
+    restored = restore_session(session)
+    if (session.market == Markets.FUTURES):
+        prepare_futures_session(session)
+        reconcile_futures_session(session, restored)
+
+def print_session(session, mode=''):
+    print(white.bold('* Liquidity trading of: {} with {} as amount at {} candle with x{} leverage and at {} market starting at {} and finishing at {}{}.'.format(session.pair, session.quantity, session.interval, session.leverage, session.market, START_INTERVAL, END_INTERVAL, mode)))
+
+def main(session):
+    set_sleep_timeout(session.interval)
+    prepare_session(session)
+    track_orders([session])
+
+    print_session(session)
+    while not session.is_finished():
         if (check_open_trade_ready()):
-            order_filled = trade_the_open(pair, interval, quantity, leverage, market, side, limit, target)
-        if (not order_filled):
+            if (METRICS_ENABLED):
+                iteration_start = time.perf_counter()
+            with session.lock:
+                session.order_filled = trade_the_open(session)
+                journal_session(session)
+            if (METRICS_ENABLED):
+                observe_metric('loop_iteration_seconds', time.perf_counter() - iteration_start)
+        if (not session.order_filled):
             time.sleep(SLEEP_TIMEOUT)
 
+def step_session(session, candles):
+    # Sessions are stepped from worker threads, skip updates while the previous one is still running
+    if (not session.lock.acquire(blocking=False)):
+        return
+    try:
+        session.order_filled = trade_the_open(session, candles)
+    except Exception as e:
+        # A rejected order of one pair must not stop the other sessions
+        print(red.bold('\n\t x {} step failed: {}'.format(session.pair, e)))
+    finally:
+        journal_session(session)
+        session.lock.release()
+
+async def poll_sessions(sessions):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=SCAN_CONCURRENCY) as executor:
+        while True:
+            active = [session for session in sessions if not session.is_finished()]
+            if (not active):
+                return
+            now = datetime.utcnow()
+            if (is_trading_window(now)):
+                if (METRICS_ENABLED):
+                    iteration_start = time.perf_counter()
+                # Candles are downloaded once per pair and shared by every session trading it
+                keys = list({ (session.pair, session.interval, session.market) for session in active })
+                results = await asyncio.gather(*[get_last_binance_candles_async(*key, executor=executor) for key in keys], return_exceptions=True)
+                candles = dict(zip(keys, results))
+                steps = []
+                stepped = []
+                for session in active:
+                    session_candles = candles[(session.pair, session.interval, session.market)]
+                    if (isinstance(session_candles, Exception) or len(session_candles) < 2):
+                        continue
+                    steps.append(loop.run_in_executor(executor, step_session, session, session_candles))
+                    stepped.append(session)
+                for session, result in zip(stepped, await asyncio.gather(*steps, return_exceptions=True)):
+                    if (isinstance(result, Exception)):
+                        print(red.bold('\n\t x {} step failed: {}'.format(session.pair, result)))
+                if (METRICS_ENABLED):
+                    observe_metric('loop_iteration_seconds', time.perf_counter() - iteration_start)
+            else:
+                print(yellow("\nChecking candle open: {} -> False. Checking {} pairs again in {} seconds.".format(now.strftime('%B %d %Y - %H:%M:%S'), len(active), SLEEP_TIMEOUT)))
+            await asyncio.sleep(SLEEP_TIMEOUT)
+
+def run_sessions(sessions):
+    import asyncio
+    set_sleep_timeout(sessions[0].interval)
+    for session in sessions:
+        prepare_session(session)
+        print_session(session)
+    track_orders(sessions)
+    asyncio.run(poll_sessions(sessions))
+
+def get_kline_stream_name(pair, interval, market=Markets.FUTURES):
+    if (market == Markets.SPOT):
+        return '{}@kline_{}'.format(pair.lower(), interval)
+    return '{}_perpetual@continuousKline_{}'.format(pair.lower(), interval)
+
+def get_kline_stream_url(streams, market=Markets.FUTURES):
+    base_url = BINANCE_SPOT_STREAM_URL if market == Markets.SPOT else BINANCE_FUTURES_STREAM_URL
+    return '{}/stream?streams={}'.format(base_url, '/'.join(streams))
+
+def parse_stream_kline(data):
+    kline = data['k']
+    candles = np.array([(kline['t'], float(kline['o']), float(kline['h']), float(kline['l']), float(kline['c']), float(kline['v']), kline['T'], kline['n'])], dtype=CANDLE_DTYPE)
+    return candles, kline['x']
+
+def run_kline_stream(url, on_open, on_message, is_finished):
+    import websocket
+    reconnect_delay = [STREAM_RECONNECT_DELAY]
+
+    def on_stream_open(ws):
+        on_open(ws)
+        reconnect_delay[0] = STREAM_RECONNECT_DELAY
+
+    def on_error(ws, error):
+        print(red.bold('Kline stream error: {}'.format(error)))
+
+    while not is_finished():
+        ws = websocket.WebSocketApp(url, on_open=on_stream_open, on_message=on_message, on_error=on_error)
+        ws.run_forever(ping_interval=STREAM_PING_INTERVAL)
+        if (not is_finished()):
+            print(yellow('Kline stream closed, reconnecting in {} seconds.'.format(reconnect_delay[0])))
+            time.sleep(reconnect_delay[0])
+            reconnect_delay[0] = min(reconnect_delay[0] * 2, STREAM_MAX_RECONNECT_DELAY)
+
+def stream_sessions(sessions):
+    market = sessions[0].market
+    # One combined stream connection for every pair traded, synthesized
+    # intervals listen to the stream of the interval they are built from
+    streams = {}
+    for session in sessions:
+        streams.setdefault(get_kline_stream_name(session.pair, get_source_interval(session.interval), market), []).append(session)
+    state = { name: { 'open_time': None, 'closed': True } for name in streams }
+    synthesized = {}
+    last_closes = {}
+    executor = ThreadPoolExecutor(max_workers=SCAN_CONCURRENCY)
+
+    def is_finished():
+        return all(session.is_finished() for session in sessions)
+
+    def load_synthesized(key):
+        synthesized[key] = list(load_synthesized_candles(key[0], key[1], market))
+
+    def on_open(ws):
+        # Fill the candles missed while disconnected before reacting to updates
+        keys = { (session.pair, get_source_interval(session.interval)) for session in sessions }
+        list(executor.map(lambda key: sync_binance_candles(key[0], key[1], market), keys))
+        keys = { (session.pair, session.interval) for session in sessions if get_source_interval(session.interval) != session.interval }
+        list(executor.map(load_synthesized, keys))
+        print(yellow('\nConnected to {} kline streams.'.format(len(streams))))
+
+    def get_stream_candles(pair, interval, base_candle):
+        source = get_source_interval(interval)
+        if (source == interval):
+            return read_binance_candles(pair, interval, market, 2)
+        previous, current = synthesized[(pair, interval)]
+        if (current is not None and get_interval_open_time(int(base_candle['open_time']), interval) != current['open_time']):
+            previous = synthesized_candle_row(current, interval)
+        current = update_synthesized_candle(current, base_candle, interval)
+        synthesized[(pair, interval)] = [previous, current]
+        if (previous is None):
+            return []
+        return np.array([previous, synthesized_candle_row(current, interval)], dtype=CANDLE_DTYPE)
+
+    def on_step_done(ws, step, session):
+        if (step.exception() is not None):
+            print(red.bold('\n\t x {} step failed: {}'.format(session.pair, step.exception())))
+        if (is_finished()):
+            ws.close()
+
+    def on_message(ws, message):
+        message = loads_json(message)
+        pair_sessions = streams.get(message['stream'])
+        if (pair_sessions is None):
+            return
+        pair = pair_sessions[0].pair
+        source = get_source_interval(pair_sessions[0].interval)
+        stream_state = state[message['stream']]
+        stream_candles, closed = parse_stream_kline(message['data'])
+        candle = stream_candles[0]
+        if (stream_state['open_time'] is not None and candle['open_time'] != stream_state['open_time'] and not stream_state['closed']):
+            # Final update of the previous candle was missed
+            sync_binance_candles(pair, source, market)
+            for key in synthesized:
+                if (key[0] == pair and get_source_interval(key[1]) == source):
+                    load_synthesized(key)
+        stream_state['open_time'] = candle['open_time']
+        stream_state['closed'] = closed
+        save_binance_candles(pair, source, market, stream_candles)
+        if (PAPER_EXCHANGE is not None and market == Markets.FUTURES):
+            PAPER_EXCHANGE.update_price(pair, candle, source)
+        interval_candles = { interval: get_stream_candles(pair, interval, candle) for interval in { session.interval for session in pair_sessions } }
+        if (not is_trading_window(datetime.utcnow())):
+            return
+        for session in pair_sessions:
+            candles = interval_candles[session.interval]
+            if (len(candles) < 2 or session.is_finished() or last_closes.get(id(session)) == candle['close']):
+                continue
+            last_closes[id(session)] = candle['close']
+            step = executor.submit(step_session, session, candles)
+            step.add_done_callback(lambda step, session=session: on_step_done(ws, step, session))
+
+    for session in sessions:
+        prepare_session(session)
+        print_session(session, ' (streaming)')
+    track_orders(sessions)
+    if (market == Markets.FUTURES):
+        threading.Thread(target=keep_connection_warm, args=(BINANCE_FUTURES_BASE_URL, BINANCE_FUTURES_PING_ENDPOINT, is_finished), daemon=True).start()
+    run_kline_stream(get_kline_stream_url(list(streams), market), on_open, on_message, is_finished)
+    executor.shutdown()
+
+def load_candle_arrays(pair, interval, market=Markets.FUTURES, start_time=0):
+    sync_interval_candles(pair, interval, market, start_time)
+    candles = read_interval_candles(pair, interval, market, start_time)
+    return { field: np.ascontiguousarray(candles[field]) for field in ('open_time', 'open', 'high', 'low', 'close', 'close_time') }
+
+def get_backtest_targets(cc_open, cc_high, cc_close):
+    # Fibonacci targets come from the previous candle, same as trade_the_open
+    lc_open = np.roll(cc_open, 1)
+    lc_high = np.roll(cc_high, 1)
+    lc_close = np.roll(cc_close, 1)
+    return fib_retracement(np.where(lc_open < lc_close, lc_close, lc_open), lc_high)
+
+def prepare_backtest(candles, sub_candles, side=MarketSide.LONG):
+    # Short trades are replayed as long trades over mirrored prices (-price), so
+    # the decision rules below are the LONG branch of trade_the_open only
+    sign = 1.0 if side == MarketSide.LONG else -1.0
+    if (side == MarketSide.LONG):
+        cc_open, cc_high, cc_close = candles['open'], candles['high'], candles['close']
+        sub_high, sub_low, sub_close = sub_candles['high'], sub_candles['low'], sub_candles['close']
+    else:
+        cc_open, cc_high, cc_close = -candles['open'], -candles['low'], -candles['close']
+        sub_high, sub_low, sub_close = -sub_candles['low'], -sub_candles['high'], -sub_candles['close']
+
+    # Lay sub candles out as a (candle, step) matrix, one row per traded candle
+    count = len(candles['open_time'])
+    parent = np.searchsorted(candles['open_time'], sub_candles['open_time'], side='right') - 1
+    keep = parent >= 0
+    keep[keep] = sub_candles['open_time'][keep] <= candles['close_time'][parent[keep]]
+    parent = parent[keep]
+    sub_time = sub_candles['open_time'][keep]
+    column = np.arange(len(parent)) - np.searchsorted(parent, np.arange(count))[parent]
+    steps = int(column.max()) + 1 if len(column) else 1
+    shape = (count, steps)
+
+    step_high = np.full(shape, -np.inf)
+    step_high[parent, column] = sub_high[keep]
+    step_low = np.full(shape, np.inf)
+    step_low[parent, column] = sub_low[keep]
+    step_close = np.full(shape, np.nan)
+    step_close[parent, column] = sub_close[keep]
+    step_time = np.zeros(shape, dtype=np.int64)
+    step_time[parent, column] = sub_time
+    step_hour = np.full(shape, -1, dtype=np.int64)
+    step_hour[parent, column] = (sub_time // 3600000) % 24
+
+    steps_per_candle = np.bincount(parent, minlength=count)
+    last_close = step_close[np.arange(count), np.maximum(steps_per_candle - 1, 0)]
+
+    targets = get_backtest_targets(cc_open, cc_high, cc_close)
+    tradeable = steps_per_candle > 0
+    tradeable[0] = False
+
+    return {
+        'side': side,
+        'sign': sign,
+        'open_time': candles['open_time'],
+        'open': cc_open,
+        'targets': targets,
+        'tradeable': tradeable,
+        'step_time': step_time,
+        'step_hour': step_hour,
+        'step_high': step_high,
+        'step_low': step_low,
+        'step_close': step_close,
+        'running_low': np.minimum.accumulate(step_low, axis=1),
+        'last_close': last_close,
+    }
+
+def backtest_the_open(prepared, target=1, risk=MAX_STOP_LOSS_RISK, start=START_INTERVAL, end=END_INTERVAL, leverage=1, quantity=1, fee=BACKTEST_FEE):
+    sign = prepared['sign']
+    cc_open = prepared['open']
+    step_close = prepared['step_close']
+    running_low = prepared['running_low']
+    count, steps = step_close.shape
+    rows = np.arange(count)
+    columns = np.arange(steps)
+
+    window = (prepared['step_hour'] >= start) & (prepared['step_hour'] <= end)
+    green = window & (step_close > cc_open[:, None])
+    red = window & (step_close <= cc_open[:, None])
+    take_profit = prepared['targets'][target]
+
+    active = prepared['tradeable'].copy()
+    search_from = np.zeros(count, dtype=np.int64)
+    last_low = np.full(count, np.inf)
+    trades = []
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Every retry is evaluated for all candles at once
+        for attempt in range(MAX_ORDER_RETRIES):
+            entry_mask = green & (columns >= search_from[:, None]) & (running_low < last_low[:, None])
+            entered = active & entry_mask.any(axis=1)
+            entry = entry_mask.argmax(axis=1)
+            entry_price = step_close[rows, entry]
+            stop_loss = running_low[rows, entry]
+
+            if (prepared['side'] == MarketSide.LONG):
+                trade_risk = stop_loss_risk(stop_loss, cc_open)
+            else:
+                trade_risk = stop_loss_risk(-cc_open, -stop_loss)
+            # Too risky trades or targets already passed end the candle, as they do live
+            opened = entered & (trade_risk < risk) & (take_profit > entry_price)
+
+            after_entry = columns > entry[:, None]
+            stop_mask = after_entry & (prepared['step_low'] <= stop_loss[:, None])
+            target_mask = after_entry & (prepared['step_high'] >= take_profit[:, None])
+            stop_at = np.where(stop_mask.any(axis=1), stop_mask.argmax(axis=1), steps)
+            target_at = np.where(target_mask.any(axis=1), target_mask.argmax(axis=1), steps)
+            # Candle resolution can not tell which came first, assume the stop
+            stopped = opened & (stop_at < steps) & (stop_at <= target_at)
+            reached = opened & (target_at < stop_at)
+            exit_price = np.where(stopped, stop_loss, np.where(reached, take_profit, prepared['last_close']))
+
+            trades.append({
+                'candle_time': prepared['open_time'][opened],
+                'entry_time': prepared['step_time'][rows, entry][opened],
+                'attempt': np.full(opened.sum(), attempt + 1),
+                'entry': sign * entry_price[opened],
+                'stop_loss': sign * stop_loss[opened],
+                'target': sign * take_profit[opened],
+                'exit': sign * exit_price[opened],
+                'result': np.where(reached, 1, np.where(stopped, -1, 0))[opened],
+            })
+
+            # Retrying needs the candle to turn red again after the stop and a lower low
+            red_mask = red & (columns >= stop_at[:, None])
+            search_from = np.where(red_mask.any(axis=1), red_mask.argmax(axis=1) + 1, steps)
+            last_low = stop_loss
+            active = stopped
+
+    result = { key: np.concatenate([trade[key] for trade in trades]) for key in trades[0] }
+    return finish_backtest_trades(result, sign, leverage, quantity, fee)
+
+def finish_backtest_trades(result, sign, leverage=1, quantity=1, fee=BACKTEST_FEE):
+    order = np.argsort(result['entry_time'], kind='stable')
+    result = { key: value[order] for key, value in result.items() }
+    change = sign * (result['exit'] - result['entry']) / result['entry']
+    result['pnl'] = quantity * leverage * (change - 2 * fee)
+    return result
+
+def read_tick_lines(path):
+    import gzip
+    import mmap
+    import zipfile
+    if (path.endswith('.zip')):
+        with zipfile.ZipFile(path) as archive, archive.open(archive.namelist()[0]) as f:
+            yield from f
+    elif (path.endswith('.gz')):
+        with gzip.open(path) as f:
+            yield from f
+    else:
+        # Plain files are paged in by the OS instead of being read into memory
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield from iter(mapped.readline, b'')
+
+def parse_tick_rows(rows, columns):
+    if (columns >= 12):
+        # 1 second candles are walked open, low, high, close (open, high, low, close when red)
+        values = np.loadtxt(rows, delimiter=',', usecols=(0, 1, 2, 3, 4), ndmin=2)
+        open, high, low, close = values[:, 1], values[:, 2], values[:, 3], values[:, 4]
+        green = close >= open
+        prices = np.column_stack((open, np.where(green, low, high), np.where(green, high, low), close)).ravel()
+        times = np.repeat(values[:, 0].astype(np.int64), 4)
+    else:
+        # Aggregated trades: id, price, quantity, first id, last id, time, buyer maker
+        values = np.loadtxt(rows, delimiter=',', usecols=(5, 1), ndmin=2)
+        times, prices = values[:, 0].astype(np.int64), values[:, 1]
+    if (len(times) and times[-1] > 10 ** 14):
+        # Newer Binance dumps have microsecond timestamps
+        times //= 1000
+    return times, prices
+
+def read_tick_chunks(path, chunk_size=TICK_CHUNK_SIZE):
+    if (path.endswith('.npy')):
+        # Structured time and price arrays are memory mapped
+        ticks = np.load(path, mmap_mode='r')
+        for i in range(0, len(ticks), chunk_size):
+            chunk = ticks[i:i + chunk_size]
+            yield np.asarray(chunk['time'], dtype=np.int64), np.asarray(chunk['price'], dtype=np.float64)
+        return
+    lines = read_tick_lines(path)
+    first = next(lines, b'')
+    columns = first.count(b',') + 1
+    if (first[:1].isdigit()):
+        lines = itertools.chain([first], lines)
+    while True:
+        rows = list(itertools.islice(lines, chunk_size))
+        if (not rows):
+            break
+        yield parse_tick_rows(rows, columns)
+
+def read_ticks(paths, chunk_size=TICK_CHUNK_SIZE):
+    for path in paths:
+        yield from read_tick_chunks(path, chunk_size)
+
+def close_tick_trade(replay, exit_price, result):
+    replay['trades'].append((replay['candle_time'], replay['entry_time'], replay['attempt'], replay['entry'], replay['stop_loss'], replay['target'], exit_price, result))
+
+def replay_candle_ticks(replay, times, prices, window, cc_open, risk, side):
+    # Jumps from one decision to the next with vectorized searches over the ticks
+    i = 0
+    count = len(prices)
+    while (i < count):
+        phase = replay['phase']
+        if (phase == 'entry'):
+            running_low = np.minimum.accumulate(prices[i:])
+            np.minimum(running_low, replay['running_low'], out=running_low)
+            entry_mask = window[i:] & (prices[i:] > cc_open) & (running_low < replay['last_low'])
+            j = entry_mask.argmax()
+            if (not entry_mask[j]):
+                break
+            entry_price, stop_loss = prices[i + j], running_low[j]
+            if (side == MarketSide.LONG):
+                trade_risk = stop_loss_risk(stop_loss, cc_open)
+            else:
+                trade_risk = stop_loss_risk(-cc_open, -stop_loss)
+            if (trade_risk >= risk or replay['target'] <= entry_price):
+                replay['phase'] = 'done'
+                break
+            replay.update(phase='open', attempt=replay['attempt'] + 1, entry=entry_price, entry_time=times[i + j], stop_loss=stop_loss)
+            i += j + 1
+        elif (phase == 'open'):
+            exit_mask = (prices[i:] <= replay['stop_loss']) | (prices[i:] >= replay['target'])
+            j = exit_mask.argmax()
+            if (not exit_mask[j]):
+                break
+            if (prices[i + j] >= replay['target']):
+                close_tick_trade(replay, replay['target'], 1)
+                replay['phase'] = 'done'
+            else:
+                close_tick_trade(replay, replay['stop_loss'], -1)
+                replay['last_low'] = replay['stop_loss']
+                replay['phase'] = 'red' if replay['attempt'] < MAX_ORDER_RETRIES else 'done'
+            i += j
+        elif (phase == 'red'):
+            # Retrying needs the candle to turn red again after the stop and a lower low
+            red_mask = window[i:] & (prices[i:] <= cc_open)
+            j = red_mask.argmax()
+            if (not red_mask[j]):
+                break
+            replay['phase'] = 'entry'
+            replay['running_low'] = min(replay['running_low'], prices[:i + j + 1].min())
+            i += j + 1
+        else:
+            break
+    replay['running_low'] = min(replay['running_low'], prices.min())
+    replay['last_price'] = prices[-1]
+
+def replay_ticks(candles, ticks, side=MarketSide.LONG, risk=MAX_STOP_LOSS_RISK, start=START_INTERVAL, end=END_INTERVAL, leverage=1, quantity=1, fee=BACKTEST_FEE, levels=(1, 2, 3, 4)):
+    # Same rules as backtest_the_open, with every trade instead of sub candles deciding
+    # whether the stop loss or the target came first
+    sign = 1.0 if side == MarketSide.LONG else -1.0
+    if (side == MarketSide.LONG):
+        cc_open, cc_high, cc_close = candles['open'], candles['high'], candles['close']
+    else:
+        cc_open, cc_high, cc_close = -candles['open'], -candles['low'], -candles['close']
+    targets = get_backtest_targets(cc_open, cc_high, cc_close)
+    replays = { level: { 'trades': [], 'candle': -1, 'phase': 'done' } for level in levels }
+
+    events = 0
+    for times, prices in ticks:
+        events += len(times)
+        prices = sign * prices
+        parent = np.searchsorted(candles['open_time'], times, side='right') - 1
+        hours = (times // 3600000) % 24
+        window = (hours >= start) & (hours <= end)
+        bounds = np.flatnonzero(parent[1:] != parent[:-1]) + 1
+        for begin, finish in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(parent)]))):
+            candle = parent[begin]
+            # Ticks out of the stored candles and the first candle (no targets) are skipped
+            if (candle < 1 or times[begin] > candles['close_time'][candle]):
+                continue
+            for level, replay in replays.items():
+                if (replay['candle'] != candle):
+                    if (replay['phase'] == 'open'):
+                        close_tick_trade(replay, replay['last_price'], 0)
+                    replay.update(candle=candle, candle_time=candles['open_time'][candle], phase='entry', attempt=0, last_low=np.inf, running_low=np.inf, target=targets[level][candle])
+                replay_candle_ticks(replay, times[begin:finish], prices[begin:finish], window[begin:finish], cc_open[candle], risk, side)
+
+    results = {}
+    for level, replay in replays.items():
+        if (replay['phase'] == 'open'):
+            close_tick_trade(replay, replay['last_price'], 0)
+        trades = np.array(replay['trades'], dtype=np.float64).reshape(-1, 8)
+        result = {
+            'candle_time': trades[:, 0].astype(np.int64),
+            'entry_time': trades[:, 1].astype(np.int64),
+            'attempt': trades[:, 2].astype(np.int64),
+            'entry': sign * trades[:, 3],
+            'stop_loss': sign * trades[:, 4],
+            'target': sign * trades[:, 5],
+            'exit': sign * trades[:, 6],
+            'result': trades[:, 7].astype(np.int64),
+        }
+        results[level] = finish_backtest_trades(result, sign, leverage, quantity, fee)
+    return results, events
+
+def backtest_summary(trades):
+    equity = np.concatenate(([0.0], np.cumsum(trades['pnl'])))
+    drawdown = np.maximum.accumulate(equity) - equity
+    count = len(trades['pnl'])
+    return {
+        'trades': count,
+        'hit_rate': float((trades['result'] == 1).mean()) * 100 if count else 0.0,
+        'pnl': float(equity[-1]),
+        'max_drawdown': float(drawdown.max()),
+    }
+
+def run_backtest(pairs, interval, market, side, since, resolution=BACKTEST_RESOLUTION, target=1, risk=MAX_STOP_LOSS_RISK, start=START_INTERVAL, end=END_INTERVAL, leverage=1, quantity=1, fee=BACKTEST_FEE, output=None, ticks=None):
+    start_time = int(since.timestamp() * 1000)
+    all_trades = []
+    for pair in pairs:
+        print(white.bold('\n* Backtesting {} {} candles since {} with {} resolution.'.format(pair, interval, since.strftime('%B %d %Y'), 'tick' if ticks else resolution)))
+        candles = load_candle_arrays(pair, interval, market, start_time)
+        if (ticks):
+            tick_files = sorted(glob.glob(ticks.format(pair=pair)))
+            if (len(candles['open_time']) < 2 or not tick_files):
+                print(red.bold('\tNot enough candles stored or no tick files for {}.'.format(pair)))
+                continue
+
+            backtest_start = time.perf_counter()
+            results, events = replay_ticks(candles, read_ticks(tick_files), side, risk, start, end, leverage, quantity, fee)
+            backtest_time = time.perf_counter() - backtest_start
+            print(yellow('\tReplayed {} ticks from {} files ({:.0f} ticks per second).'.format(events, len(tick_files), events / backtest_time)))
+        else:
+            sub_candles = load_candle_arrays(pair, resolution, market, start_time)
+            if (len(candles['open_time']) < 2 or len(sub_candles['open_time']) == 0):
+                print(red.bold('\tNot enough candles stored for {}.'.format(pair)))
+                continue
+
+            backtest_start = time.perf_counter()
+            prepared = prepare_backtest(candles, sub_candles, side)
+            results = { level: backtest_the_open(prepared, level, risk, start, end, leverage, quantity, fee) for level in (1, 2, 3, 4) }
+            backtest_time = time.perf_counter() - backtest_start
+
+        trades = results[target]
+        for i in range(len(trades['pnl'])):
+            color = green if trades['pnl'][i] > 0 else red
+            print(color('\t{} try {}: entry {:.8g} stop {:.8g} target {:.8g} exit {:.8g} -> {:.2f} USDT'.format(
+                datetime.utcfromtimestamp(trades['entry_time'][i] / 1000).strftime('%Y-%m-%d %H:%M'), trades['attempt'][i],
+                trades['entry'][i], trades['stop_loss'][i], trades['target'][i], trades['exit'][i], trades['pnl'][i])))
+            all_trades.append([pair, int(trades['entry_time'][i]), int(trades['attempt'][i]), trades['entry'][i], trades['stop_loss'][i], trades['target'][i], trades['exit'][i], int(trades['result'][i]), trades['pnl'][i]])
+
+        for level, level_trades in results.items():
+            summary = backtest_summary(level_trades)
+            print(white.bold('\tTarget {}: {} trades, {:.2f}% hit rate, {:.2f} USDT P&L, {:.2f} USDT max drawdown.'.format(
+                level, summary['trades'], summary['hit_rate'], summary['pnl'], summary['max_drawdown'])))
+        print(yellow('\tReplayed in {:.3f} seconds.'.format(backtest_time)))
+
+    if (output):
+        with open(output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['pair', 'entry_time', 'attempt', 'entry', 'stop_loss', 'target', 'exit', 'result', 'pnl'])
+            writer.writerows(all_trades)
+
+def share_candle_arrays(candles):
+    from multiprocessing import shared_memory
+    shared = {}
+    blocks = []
+    for key, value in candles.items():
+        block = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+        np.ndarray(value.shape, dtype=value.dtype, buffer=block.buf)[:] = value
+        shared[key] = (block.name, value.shape, value.dtype.str)
+        blocks.append(block)
+    return shared, blocks
+
+def attach_candle_arrays(shared):
+    from multiprocessing import shared_memory
+    candles = {}
+    blocks = []
+    for key, (name, shape, dtype) in shared.items():
+        block = shared_memory.SharedMemory(name=name)
+        candles[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        blocks.append(block)
+    return candles, blocks
+
+def sweep_pair(pair, interval, side, candles, sub_candles, grid, quantity, fee):
+    prepared = prepare_backtest(candles, sub_candles, side)
+    results = []
+    for target, risk, start, end in itertools.product(grid['targets'], grid['risks'], grid['starts'], grid['ends']):
+        trades = backtest_the_open(prepared, target, risk, start, end, 1, quantity, fee)
+        # P&L scales linearly with leverage, no need to replay again
+        for leverage in grid['leverages']:
+            summary = backtest_summary(dict(trades, pnl=trades['pnl'] * leverage))
+            results.append(dict(pair=pair, interval=interval, target=target, risk=risk, start=start, end=end, leverage=leverage, **summary))
+    return results
+
+def sweep_worker(pair, interval, side, shared_candles, shared_sub_candles, grid, quantity, fee):
+    # Candles are read straight from shared memory, workers never get a pickled copy
+    candles, blocks = attach_candle_arrays(shared_candles)
+    sub_candles, sub_blocks = attach_candle_arrays(shared_sub_candles)
+    try:
+        return sweep_pair(pair, interval, side, candles, sub_candles, grid, quantity, fee)
+    finally:
+        del candles, sub_candles
+        for block in blocks + sub_blocks:
+            block.close()
+
+def run_sweep(pairs, intervals, market, side, since, grid, resolution=BACKTEST_RESOLUTION, quantity=1, fee=BACKTEST_FEE, workers=None, top=SWEEP_TOP_RESULTS, output=None):
+    from concurrent.futures import ProcessPoolExecutor
+    start_time = int(since.timestamp() * 1000)
+    blocks = []
+    tasks = []
+    try:
+        sub_candles = {}
+        for pair in pairs:
+            print('\t * Loading {} {} candles'.format(pair, resolution))
+            sub_candles[pair] = share_candle_arrays(load_candle_arrays(pair, resolution, market, start_time))
+            blocks += sub_candles[pair][1]
+            for interval in intervals:
+                print('\t * Loading {} {} candles'.format(pair, interval))
+                shared, interval_blocks = share_candle_arrays(load_candle_arrays(pair, interval, market, start_time))
+                blocks += interval_blocks
+                tasks.append((pair, interval, side, shared, sub_candles[pair][0], grid, quantity, fee))
+
+        sweep_start = time.perf_counter()
+        results = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            sweeps = { executor.submit(sweep_worker, *task): task for task in tasks }
+            for sweep in as_completed(sweeps):
+                try:
+                    results += sweep.result()
+                except Exception as e:
+                    print(red('\t x Could not sweep {} {}: {}'.format(sweeps[sweep][0], sweeps[sweep][1], e)))
+        sweep_time = time.perf_counter() - sweep_start
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    results.sort(key=lambda k: k['pnl'], reverse=True)
+    print(white.bold('\nBest parameters found are:'))
+    print(white.bold('\t{:<14} {:>8} {:>6} {:>4} {:>5} {:>3} {:>8} {:>6} {:>8} {:>10} {:>12}'.format('PAIR', 'INTERVAL', 'TARGET', 'RISK', 'START', 'END', 'LEVERAGE', 'TRADES', 'HIT RATE', 'P&L', 'MAX DD')))
+    for item in results[0:top]:
+        color = green if item['pnl'] > 0 else red
+        print(color('\t{:<14} {:>8} {:>6} {:>4} {:>5} {:>3} {:>8} {:>6} {:>7.2f}% {:>10.2f} {:>12.2f}'.format(
+            item['pair'], item['interval'], item['target'], item['risk'], item['start'], item['end'], item['leverage'], item['trades'], item['hit_rate'], item['pnl'], item['max_drawdown'])))
+    print(yellow('\nSwept {} combinations in {:.2f} seconds with {} workers.'.format(len(results), sweep_time, workers or os.cpu_count())))
+
+    if (output):
+        with open(output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['pair', 'interval', 'target', 'risk', 'start', 'end', 'leverage', 'trades', 'hit_rate', 'pnl', 'max_drawdown'])
+            writer.writeheader()
+            writer.writerows(results)
+
+def parse_list(item_type):
+    return lambda s: [item_type(item) for item in s.split(',')]
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Trade the open of candles in different timeframes.')
-    parser.add_argument('--pair', type=str, help='Cryptocurrency pair to trade.')
+    parser.add_argument('--pair', type=str, help='Cryptocurrency pair to trade, or a comma separated list of pairs to trade at once.')
     parser.add_argument('--quantity', type=float, help='Quantity in USD to trade.')
     parser.add_argument('--interval', type=Intervals.from_string, choices=list(Intervals), help='Candle timeframe to trade.')
     parser.add_argument('--leverage', type=int, help='Leverage to apply on the trade.')
@@ -539,20 +2631,82 @@ if __name__ == "__main__":
     parser.add_argument('--risk', type=int, help='Risk to take with the trade.', default=4)
     parser.add_argument('--target', type=int, help='Fibonnacci target to reach.', default=4)
     parser.add_argument('--check', action='store_true', help='Check best pair to trade.')
+    parser.add_argument('--screener', action='store_true', help='Keep the top wicks of every perpetual pair updated from kline streams.')
+    parser.add_argument('--screener-port', type=int, help='Local HTTP port serving the screener top wicks as JSON.')
+    parser.add_argument('--stream', action='store_true', help='React to kline stream updates instead of polling.')
+    parser.add_argument('--metrics-file', type=str, help='File where request latency, weight and loop timings are written.')
+    parser.add_argument('--metrics-format', choices=['json', 'prometheus'], help='JSON lines appended every 10 seconds or a Prometheus text file.', default='json')
+    parser.add_argument('--concurrency', type=int, help='Maximum in-flight requests while checking pairs.', default=SCAN_CONCURRENCY)
+    parser.add_argument('--backtest', action='store_true', help='Replay stored candles through the strategy, --pair accepts a comma separated list.')
+    parser.add_argument('--since', type=lambda s: datetime.strptime(s, '%Y-%m-%d'), help='Backtest start date (YYYY-MM-DD).', default=datetime.utcnow() - timedelta(days=BACKTEST_DAYS))
+    parser.add_argument('--base-interval', type=str, choices=list(INTERVAL_MILLISECONDS), help='Build every larger candle timeframe from candles of this interval.')
+    parser.add_argument('--resolution', type=str, help='Candle interval used to replay each candle while backtesting.', default=BACKTEST_RESOLUTION)
+    parser.add_argument('--ticks', type=str, help='Aggregated trades or 1 second candles files (.csv, .zip, .gz or .npy) replayed by the backtest instead of --resolution candles, {pair} is replaced by each pair and wildcards are allowed.')
+    parser.add_argument('--fee', type=float, help='Fee rate paid on each side of a backtested or paper trade.', default=BACKTEST_FEE)
+    parser.add_argument('--paper', action='store_true', help='Fill futures orders locally against candles instead of sending them to Binance.')
+    parser.add_argument('--slippage', type=float, help='Slippage rate applied to paper market and stop fills.', default=PAPER_SLIPPAGE)
+    parser.add_argument('--max-exposure', type=float, help='Maximum USDT notional open across all futures sessions, larger trades are scaled down.')
+    parser.add_argument('--max-symbol-margin', type=float, help='Maximum USDT margin open on a single pair.')
+    parser.add_argument('--max-correlated-exposure', type=float, help='Maximum USDT notional open on pairs whose returns are correlated with the traded pair.')
+    parser.add_argument('--output', type=str, help='CSV file where backtested trades or sweep results are written, JSON file for the screener top wicks.')
+    parser.add_argument('--sweep', action='store_true', help='Backtest a grid of parameters, --pair accepts a comma separated list.')
+    parser.add_argument('--intervals', type=parse_list(Intervals.from_string), help='Comma separated candle timeframes to sweep, defaults to --interval.')
+    parser.add_argument('--targets', type=parse_list(int), help='Comma separated Fibonacci targets to sweep.', default=[1, 2, 3, 4])
+    parser.add_argument('--risks', type=parse_list(float), help='Comma separated risks to sweep.', default=[2, 3, 4])
+    parser.add_argument('--starts', type=parse_list(int), help='Comma separated candle UTC starts to sweep.', default=[0])
+    parser.add_argument('--ends', type=parse_list(int), help='Comma separated candle UTC ends to sweep.', default=[4, 8])
+    parser.add_argument('--leverages', type=parse_list(int), help='Comma separated leverages to sweep.', default=[1, 2, 5])
+    parser.add_argument('--workers', type=int, help='Worker processes used by the sweep, defaults to the number of cores.')
+    parser.add_argument('--top', type=int, help='Number of sweep results or wicks to show.')
+    parser.add_argument('--lookback', type=int, help='Closed candles used for the wick statistics of --check.', default=WICK_LOOKBACK)
 
     args = parser.parse_args()
 
+    SCAN_CONCURRENCY = args.concurrency
+    BASE_INTERVAL = args.base_interval
+    if (args.metrics_file):
+        start_metrics(args.metrics_file, args.metrics_format)
+
     if (args.check):
-        check_best_trade(args.interval.value)
+        check_best_trade(args.interval.value, args.concurrency, args.lookback, args.top or WICK_TOP_RESULTS)
+        sys.exit()
+
+    if (args.screener):
+        run_screener(args.interval.value, args.lookback, args.top or WICK_TOP_RESULTS, args.concurrency, args.screener_port, args.output)
         sys.exit()
 
     if (args.market == Markets.FUTURES):
-        args.pair = args.pair + 'USDT'
+        args.pair = ','.join([pair + 'USDT' for pair in args.pair.split(',')])
 
     START_INTERVAL = args.start
     END_INTERVAL = args.end
 
     MAX_STOP_LOSS_RISK = args.risk
-    main(args.pair, args.quantity, args.interval.value, args.leverage, args.market, args.side, args.limit, args.target)
+
+    if (args.backtest):
+        run_backtest(args.pair.split(','), args.interval.value, args.market, args.side, args.since, args.resolution, args.target, args.risk, args.start, args.end, args.leverage or 1, args.quantity or 1, args.fee, args.output, args.ticks)
+        sys.exit()
+
+    if (args.sweep):
+        grid = { 'targets': args.targets, 'risks': args.risks, 'starts': args.starts, 'ends': args.ends, 'leverages': args.leverages }
+        intervals = [interval.value for interval in (args.intervals or [args.interval])]
+        run_sweep(args.pair.split(','), intervals, args.market, args.side, args.since, grid, args.resolution, args.quantity or 1, args.fee, args.workers, args.top or SWEEP_TOP_RESULTS, args.output)
+        sys.exit()
+
+    if (args.paper):
+        PAPER_EXCHANGE = PaperExchange(args.slippage, args.fee)
+        atexit.register(PAPER_EXCHANGE.print_summary)
+
+    RISK_ENGINE = RiskEngine(args.max_exposure, args.max_symbol_margin, args.max_correlated_exposure)
+    if (args.max_correlated_exposure is not None and args.market == Markets.FUTURES):
+        RISK_ENGINE.load_correlations(args.pair.split(','), args.interval.value)
+
+    sessions = [TradeSession(pair, args.quantity, args.interval.value, args.leverage, args.market, args.side, args.limit, args.target) for pair in args.pair.split(',')]
+    if (args.stream):
+        stream_sessions(sessions)
+    elif (len(sessions) > 1):
+        run_sessions(sessions)
+    else:
+        main(sessions[0])
 
     print(green.bold('\nOrders successfully set.'))